@@ -0,0 +1,224 @@
+"""
+Alert dispatch for the CAN Network IDS
+Coalesces repeated anomalies per (CAN ID, type) into windowed summaries and
+rate-limits what reaches intrusions.log and MQTT
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from metrics import Histogram
+
+
+class AlertGroup:
+    """One ongoing incident: every anomaly of a type on an ID within a window"""
+
+    __slots__ = ('channel', 'can_id', 'anom_type', 'severity', 'first', 'last',
+                 'count', 'reported', 'dlc', 'data')
+
+    def __init__(self, channel, can_id, anom_type, severity, msg, timestamp):
+        self.channel = channel
+        self.can_id = can_id             # None for the overflow group of a type
+        self.anom_type = anom_type
+        self.severity = severity
+        self.first = timestamp
+        self.last = timestamp
+        self.count = 1
+        self.reported = 0                # Anomalies already covered by an alert
+        self.dlc = msg.dlc
+        self.data = msg.data.hex()
+
+
+class AlertAggregator:
+    """
+    Deduplicate and rate-limit alerts
+    The first CRITICAL anomaly of a (channel, CAN ID, type) incident is
+    published at once (at most max_per_second of those); repeats within
+    `window` seconds are counted and published as one summary when the
+    window closes. Windows run on frame timestamps.
+    """
+
+    def __init__(self, log_path='intrusions.log', mqtt_client=None, topic='ids/alerts',
+                 window=10.0, max_per_second=20, max_groups=1024, flush_interval=1.0):
+        self.mqtt_client = mqtt_client
+        self.topic = topic
+        self.window = window
+        self.max_per_second = max_per_second
+        self.max_groups = max_groups      # Beyond this, new IDs share one group per type
+        self.flush_interval = flush_interval
+
+        # Held open for the lifetime of the IDS; flushed by the flusher thread
+        self._log = open(log_path, 'a', buffering=65536) if log_path else None
+        self._groups = OrderedDict()      # Oldest window first
+        self._lock = threading.Lock()
+        self._tokens = float(max_per_second)
+        self._refilled = time.monotonic()
+        self._clock = None                # (newest frame timestamp, monotonic time)
+
+        # Statistics
+        self.submitted = 0
+        self.published = 0
+        self.summaries = 0
+        self.rate_limited = 0
+        self.publish_seconds = Histogram()
+
+        # Publish-to-acknowledgement latency, matched by MQTT message id
+        self._inflight = {}
+        self._acked = {}
+        self._inflight_lock = threading.Lock()
+        if mqtt_client is not None and getattr(mqtt_client, 'on_publish', None) is None:
+            mqtt_client.on_publish = self._on_publish
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ids-alerts', daemon=True)
+        self._thread.start()
+
+    def submit(self, msg, timestamp, anom_type, severity, channel=None):
+        """Record one anomaly; returns True if it opened a new incident"""
+        with self._lock:
+            self.submitted += 1
+            self._clock = (timestamp, time.monotonic())
+            self._expire(timestamp)
+
+            key = (channel, msg.arbitration_id, anom_type)
+            group = self._groups.get(key)
+            if group is None and len(self._groups) >= self.max_groups:
+                key = (channel, None, anom_type)
+                group = self._groups.get(key)
+            if group is not None:
+                group.count += 1
+                group.last = timestamp
+                return False
+
+            group = AlertGroup(channel, key[1], anom_type, severity, msg, timestamp)
+            self._groups[key] = group
+            if severity == "CRITICAL":
+                if self._take_token():
+                    group.reported = 1
+                    self._emit(group, summary=False)
+                else:
+                    self.rate_limited += 1
+            return True
+
+    def _take_token(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_per_second,
+                           self._tokens + (now - self._refilled) * self.max_per_second)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _expire(self, now):
+        """Close windows older than `window`, publishing their summaries"""
+        groups = self._groups
+        while groups:
+            group = next(iter(groups.values()))
+            if now - group.first < self.window:
+                break
+            groups.popitem(last=False)
+            self._close(group)
+
+    def _close(self, group):
+        if group.severity == "CRITICAL" and group.count > group.reported:
+            self._emit(group, summary=True)
+
+    def _emit(self, group, summary):
+        """Write one alert to intrusions.log and MQTT"""
+        when = datetime.fromtimestamp(group.last if summary else group.first).isoformat()
+        can_id = "*" if group.can_id is None else f"0x{group.can_id:03X}"
+        if summary:
+            self.summaries += 1
+        else:
+            self.published += 1
+
+        if self._log is not None:
+            line = f"{when}: {group.anom_type} on {can_id}"
+            if group.channel:
+                line += f" ({group.channel})"
+            if summary:
+                line += (f" x{group.count} from "
+                         f"{datetime.fromtimestamp(group.first).isoformat()}")
+            self._log.write(line + "\n")
+
+        if self.mqtt_client is not None:
+            alert_payload = {
+                "timestamp": when,
+                "anomaly_type": group.anom_type,
+                "can_id": can_id,
+                "data": group.data,
+                "dlc": group.dlc,
+                "channel": group.channel,
+                "severity": group.severity,
+                "summary": summary,
+                "count": group.count,
+                "first_seen": datetime.fromtimestamp(group.first).isoformat(),
+                "last_seen": datetime.fromtimestamp(group.last).isoformat(),
+            }
+            try:
+                sent = time.perf_counter()
+                info = self.mqtt_client.publish(self.topic, json.dumps(alert_payload), qos=1)
+                self._track(getattr(info, 'mid', None), sent)
+            except Exception as e:
+                print(f"   ERROR: Could not send MQTT alert: {e}")
+
+        # Further actions (email/SMS, gateway lockout) can be triggered here
+
+    def _track(self, mid, sent):
+        if mid is None:
+            return
+        with self._inflight_lock:
+            acked = self._acked.pop(mid, None)
+            if acked is not None:
+                # The network thread acknowledged before publish() returned
+                self.publish_seconds.observe(acked - sent)
+                return
+            if len(self._inflight) >= 1024:
+                self._inflight.clear()    # Broker not acknowledging; stop tracking
+            self._inflight[mid] = sent
+
+    def _on_publish(self, client, userdata, mid, *args):
+        """paho callback (either callback API version)"""
+        now = time.perf_counter()
+        with self._inflight_lock:
+            sent = self._inflight.pop(mid, None)
+            if sent is None:
+                if len(self._acked) < 1024:
+                    self._acked[mid] = now
+                return
+        self.publish_seconds.observe(now - sent)
+
+    def _run(self):
+        """Close windows that no further anomaly arrives to close"""
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                if self._clock is not None:
+                    # Advance the frame clock by the wall time since the newest frame
+                    timestamp, seen = self._clock
+                    self._expire(timestamp + time.monotonic() - seen)
+                if self._log is not None:
+                    self._log.flush()
+
+    def stats(self):
+        return {
+            'open': len(self._groups),
+            'submitted': self.submitted,
+            'published': self.published,
+            'summaries': self.summaries,
+            'rate_limited': self.rate_limited,
+        }
+
+    def close(self):
+        """Publish every open incident and close the log"""
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            while self._groups:
+                self._close(self._groups.popitem(last=False)[1])
+            if self._log is not None:
+                self._log.close()
+                self._log = None
@@ -0,0 +1,48 @@
+"""
+Anomaly codes for the CAN Network IDS
+One bit per detector finding; a frame's verdict is the OR of its bits
+"""
+
+UNKNOWN_ID = 0x01
+DLC_MISMATCH = 0x02
+INVALID_DATA = 0x04
+OUT_OF_RANGE = 0x08
+DOS_ATTACK = 0x10
+PATTERN_DEVIATION = 0x20
+TIMING_EARLY = 0x40
+TIMING_LATE = 0x80
+PAYLOAD_VALUE = 0x100
+PAYLOAD_TRANSITION = 0x200
+
+# Bit i of a mask is ANOMALY_TYPES[i]
+ANOMALY_TYPES = ('unknown_id', 'dlc_mismatch', 'invalid_data', 'out_of_range',
+                 'dos_attack', 'pattern_deviation', 'timing_early', 'timing_late',
+                 'payload_value', 'payload_transition')
+ANOMALY_BITS = {name: 1 << bit for bit, name in enumerate(ANOMALY_TYPES)}
+ANOMALY_SEVERITY = ('WARNING', 'CRITICAL', 'HIGH', 'HIGH',
+                    'CRITICAL', 'MEDIUM', 'HIGH', 'WARNING', 'HIGH', 'MEDIUM')
+
+# Ascending; a frame's severity is the highest of its findings
+SEVERITIES = ('WARNING', 'MEDIUM', 'HIGH', 'CRITICAL')
+MASK_LIMIT = 1 << len(ANOMALY_TYPES)
+
+
+def _primary(mask):
+    """Most severe finding of a mask, lowest bit first among equals"""
+    best = None
+    for bit, name in enumerate(ANOMALY_TYPES):
+        if mask >> bit & 1 and (best is None or SEVERITIES.index(ANOMALY_SEVERITY[bit]) >
+                                SEVERITIES.index(ANOMALY_SEVERITY[best])):
+            best = bit
+    return best
+
+
+# Per-mask lookups, so classifying a verdict is one index operation
+_PRIMARY_BITS = [_primary(mask) for mask in range(MASK_LIMIT)]
+MASK_TYPE = tuple(None if bit is None else ANOMALY_TYPES[bit] for bit in _PRIMARY_BITS)
+MASK_SEVERITY = tuple(None if bit is None else ANOMALY_SEVERITY[bit] for bit in _PRIMARY_BITS)
+
+
+def anomaly_names(mask):
+    """Every finding in a mask, in bit order"""
+    return [name for bit, name in enumerate(ANOMALY_TYPES) if mask >> bit & 1]
@@ -0,0 +1,173 @@
+"""
+asyncio front-end for the CAN Network IDS
+One event loop reads every bus through can.Notifier and runs detection,
+persistence and alerting as coroutines joined by bounded queues
+"""
+
+import asyncio
+
+import can
+
+
+class BoundedReader(can.AsyncBufferedReader):
+    """AsyncBufferedReader that sheds frames instead of growing without bound
+
+    A bus cannot be paused, so when detection falls behind the excess is
+    dropped (and counted) here, at the edge of the event loop.
+    """
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.buffer = asyncio.Queue(maxsize=capacity)
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def on_message_received(self, msg):
+        if self._is_stopped:
+            return
+        try:
+            self.buffer.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self.received += 1
+        depth = self.buffer.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+
+
+class AsyncIDS:
+    """Serve one or more CANNetworkIDS instances from a single event loop
+
+    Each bus feeds a BoundedReader via can.Notifier (socket readiness on the
+    loop where the interface has a file descriptor). A detection coroutine
+    per bus classifies frames in bursts and awaits room in the persist and
+    alert queues, so a slow sink throttles detection rather than memory.
+    """
+
+    def __init__(self, detectors, rx_capacity=65536, sink_capacity=65536,
+                 burst=256):
+        self.detectors = list(detectors)
+        self.rx_capacity = rx_capacity
+        self.sink_capacity = sink_capacity
+        self.burst = burst                # Frames classified before yielding
+        self.readers = {}
+        self.notifiers = []
+        self.persisted = 0
+        self.alerted = 0
+        self._persist = None
+        self._alerts = None
+
+    async def _detect(self, ids, reader):
+        """Detection stage for one bus"""
+        buffer = reader.buffer
+        while True:
+            burst = [await buffer.get()]
+            while len(burst) < self.burst and not buffer.empty():
+                burst.append(buffer.get_nowait())
+
+            for msg in burst:
+                timestamp = ids._frame_time(msg)
+                ids._observe(msg, timestamp)
+
+                mask = ids._detect_anomalies(msg, timestamp)
+
+                for row in ids._stored_rows(msg, timestamp, mask != 0):
+                    await self._persist.put((ids.db, row))
+                if mask:
+                    await self._alerts.put((ids, msg, timestamp, mask))
+                ids._after_detect(msg, mask)
+            # Let the sinks and the other buses run between bursts
+            await asyncio.sleep(0)
+
+    async def _persist_rows(self):
+        """Persistence stage: hand rows to the database writer in batches"""
+        queue = self._persist
+        while True:
+            batches = {}
+            db, row = await queue.get()
+            batches.setdefault(db, []).append(row)
+            while not queue.empty():
+                db, row = queue.get_nowait()
+                batches.setdefault(db, []).append(row)
+
+            for db, rows in batches.items():
+                # Wait for the writer thread instead of letting it drop rows
+                while db.pending() + len(rows) > db.max_pending:
+                    await asyncio.sleep(db.flush_interval / 10)
+                db.log_messages(rows)
+                self.persisted += len(rows)
+                for _ in rows:
+                    queue.task_done()
+
+    async def _alert(self):
+        """Alerting stage: anomaly log, database row, intrusions.log, MQTT"""
+        queue = self._alerts
+        while True:
+            ids, msg, timestamp, mask = await queue.get()
+            try:
+                ids._handle_anomaly(msg, timestamp, mask)
+            except Exception as e:
+                print(f"Warning: alert stage failed: {e}")
+            self.alerted += 1
+            queue.task_done()
+
+    async def serve(self):
+        """Run until cancelled, then flush whatever the sinks still hold"""
+        loop = asyncio.get_running_loop()
+        self._persist = asyncio.Queue(maxsize=self.sink_capacity)
+        self._alerts = asyncio.Queue(maxsize=self.sink_capacity)
+
+        tasks = []
+        for ids in self.detectors:
+            reader = BoundedReader(self.rx_capacity)
+            self.readers[ids.channel] = reader
+            self.notifiers.append(can.Notifier(ids.bus, [reader], loop=loop))
+            ids.pipeline = self
+            tasks.append(asyncio.create_task(self._detect(ids, reader),
+                                             name=f"ids-detect-{ids.channel}"))
+        sinks = [asyncio.create_task(self._persist_rows(), name='ids-persist'),
+                 asyncio.create_task(self._alert(), name='ids-alert')]
+
+        try:
+            # Only detection is awaited here: cancelling serve() must leave
+            # the sinks running until they have drained below
+            await asyncio.gather(*tasks)
+        finally:
+            for notifier in self.notifiers:
+                notifier.stop()
+            for task in tasks:
+                task.cancel()
+            # Drain frames already classified before stopping the sinks
+            try:
+                await asyncio.wait_for(asyncio.gather(self._persist.join(),
+                                                      self._alerts.join()), timeout=5.0)
+            except asyncio.TimeoutError:
+                print(f"Warning: {self._persist.qsize() + self._alerts.qsize()} "
+                      f"queued rows/alerts not flushed")
+            for task in sinks:
+                task.cancel()
+
+    def run(self):
+        """Blocking entry point; Ctrl+C stops the loop and flushes the sinks"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    def stats(self):
+        """Per-bus receive counters and sink queue depths"""
+        stats = {}
+        for channel, reader in self.readers.items():
+            stats[f"receive[{channel}]"] = {
+                'depth': reader.buffer.qsize(),
+                'high_water': reader.high_water,
+                'received': reader.received,
+                'dropped': reader.dropped,
+            }
+        stats['persist'] = {'depth': self._persist.qsize() if self._persist else 0,
+                            'processed': self.persisted}
+        stats['alert'] = {'depth': self._alerts.qsize() if self._alerts else 0,
+                          'processed': self.alerted}
+        return stats
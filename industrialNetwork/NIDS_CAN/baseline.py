@@ -0,0 +1,135 @@
+"""
+On-disk baseline format for the CAN Network IDS
+Learned per-ID state stored as a versioned NumPy .npz archive
+"""
+
+import os
+import time
+
+import numpy as np
+
+from detectors import MAX_DLC, InterArrivalModel, PayloadProfile, PayloadStats
+
+# 2: payload profiles (version 1 archives still load, without them)
+BASELINE_VERSION = 2
+
+
+def _nan_if_none(value):
+    return np.nan if value is None else value
+
+
+def _none_if_nan(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def save_baseline(path, baseline_dlc, payload_stats, interarrival, payload_profiles=None):
+    """Write learned baseline state for every ID in baseline_dlc"""
+    payload_profiles = payload_profiles or {}
+    ids = sorted(baseline_dlc)
+    n = len(ids)
+    arrays = {
+        'version': np.array(BASELINE_VERSION),
+        'created': np.array(time.time()),
+        'ids': np.array(ids, dtype=np.uint32),
+        'dlc': np.array([baseline_dlc[i] for i in ids], dtype=np.int16),
+        'payload_samples': np.zeros(n, dtype=np.int64),
+        'payload_count': np.zeros((n, MAX_DLC), dtype=np.int64),
+        'payload_mean': np.zeros((n, MAX_DLC)),
+        'payload_m2': np.zeros((n, MAX_DLC)),
+        'payload_min': np.full((n, MAX_DLC), 255, dtype=np.uint8),
+        'payload_max': np.zeros((n, MAX_DLC), dtype=np.uint8),
+        # Timing columns: count, mean, m2, p_low, p_high, lower, upper
+        'timing': np.full((n, 7), np.nan),
+        # Payload profiles (learned state; tables are compiled on load)
+        'profile_samples': np.zeros(n, dtype=np.int64),
+        'profile_histogram': np.zeros((n, MAX_DLC, 256), dtype=np.uint32),
+        'profile_max_step': np.zeros((n, MAX_DLC), dtype=np.uint8),
+        'profile_bits': np.zeros((n, 2), dtype=np.uint64),                # AND, OR
+        'profile_enumerable': np.zeros((n, MAX_DLC), dtype=bool),        # Transitions kept
+    }
+    transitions = []    # (row, position, prev << 8 | value)
+    for row, can_id in enumerate(ids):
+        stats = payload_stats.get(can_id)
+        if stats is not None:
+            arrays['payload_samples'][row] = stats.samples
+            arrays['payload_count'][row] = stats.count
+            arrays['payload_mean'][row] = stats.mean
+            arrays['payload_m2'][row] = stats.m2
+            arrays['payload_min'][row] = stats.min
+            arrays['payload_max'][row] = stats.max
+        model = interarrival.get(can_id)
+        if model is not None:
+            arrays['timing'][row] = [model.count, model.mean, model.m2,
+                                     _nan_if_none(model.p_low), _nan_if_none(model.p_high),
+                                     _nan_if_none(model.lower), _nan_if_none(model.upper)]
+        profile = payload_profiles.get(can_id)
+        if profile is not None and profile.samples:
+            arrays['profile_samples'][row] = profile.samples
+            arrays['profile_histogram'][row] = profile.histogram
+            arrays['profile_max_step'][row] = profile.max_step
+            arrays['profile_bits'][row] = [profile.and_bits, profile.or_bits]
+            for position, pairs in enumerate(profile.transitions):
+                if pairs is not None:
+                    arrays['profile_enumerable'][row, position] = True
+                    transitions.extend((row, position, pair) for pair in pairs)
+    arrays['profile_transitions'] = np.array(transitions, dtype=np.uint32).reshape(-1, 3)
+
+    # Write next to the target and rename, so a crash never leaves half a file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_baseline(path):
+    """Read a baseline archive
+
+    Returns (baseline_dlc, payload_stats, interarrival, payload_profiles)
+    dicts keyed by CAN ID. Profiles still need PayloadProfile.finalize().
+    """
+    with np.load(path) as archive:
+        version = int(archive['version'])
+        if version not in (1, BASELINE_VERSION):
+            raise ValueError(f"Unsupported baseline version {version} in {path} "
+                             f"(expected {BASELINE_VERSION})")
+        arrays = {key: archive[key] for key in archive.files}
+
+    baseline_dlc, payload_stats, interarrival, payload_profiles = {}, {}, {}, {}
+    for row, can_id in enumerate(arrays['ids'].tolist()):
+        baseline_dlc[can_id] = int(arrays['dlc'][row])
+
+        stats = PayloadStats()
+        stats.samples = int(arrays['payload_samples'][row])
+        stats.count = arrays['payload_count'][row].tolist()
+        stats.mean = arrays['payload_mean'][row].tolist()
+        stats.m2 = arrays['payload_m2'][row].tolist()
+        stats.min = arrays['payload_min'][row].tolist()
+        stats.max = arrays['payload_max'][row].tolist()
+        payload_stats[can_id] = stats
+
+        count, mean, m2, p_low, p_high, lower, upper = arrays['timing'][row].tolist()
+        if not np.isnan(count):
+            model = InterArrivalModel()
+            model.count = int(count)
+            model.mean, model.m2 = mean, m2
+            model.p_low, model.p_high = _none_if_nan(p_low), _none_if_nan(p_high)
+            model.lower, model.upper = _none_if_nan(lower), _none_if_nan(upper)
+            interarrival[can_id] = model
+
+    if 'profile_samples' not in arrays:
+        return baseline_dlc, payload_stats, interarrival, payload_profiles
+    ids = arrays['ids'].tolist()
+    for row in np.flatnonzero(arrays['profile_samples']).tolist():
+        profile = PayloadProfile()
+        profile.samples = int(arrays['profile_samples'][row])
+        profile.histogram = arrays['profile_histogram'][row].tolist()
+        profile.max_step = arrays['profile_max_step'][row].tolist()
+        profile.and_bits, profile.or_bits = (int(bits) for bits in arrays['profile_bits'][row])
+        profile.transitions = [set() if enumerable else None
+                               for enumerable in arrays['profile_enumerable'][row].tolist()]
+        payload_profiles[ids[row]] = profile
+    for row, position, pair in arrays['profile_transitions'].tolist():
+        payload_profiles[ids[row]].transitions[position].add(pair)
+
+    return baseline_dlc, payload_stats, interarrival, payload_profiles
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Throughput and latency benchmark for the CAN Network IDS
+Drives CANNetworkIDS with synthetic traffic from the attack toolkit's generators
+"""
+
+import argparse
+import asyncio
+import contextlib
+import heapq
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import can
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'attacks', 'CANbus'))
+from can_attacks import next_id, rand_payload    # noqa: E402
+
+from async_ids import AsyncIDS                   # noqa: E402
+from detectors import FrameBatch                 # noqa: E402
+from main import CANNetworkIDS                   # noqa: E402
+from pipeline import IDSPipeline                 # noqa: E402
+
+# Benign periodic senders: CAN ID, period (s), payload generator
+BENIGN = (
+    (0x201, 0.020, lambda: bytes([random.randint(0, 3), random.randint(100, 160)])),
+    (0x330, 0.100, lambda: (2400 + random.randint(-50, 50)).to_bytes(2, 'big')),
+    (0x410, 0.100, lambda: bytes([random.randint(0, 1)])),
+    (0x510, 0.050, lambda: (300 + random.randint(-20, 20)).to_bytes(2, 'big')),
+    (0x610, 0.050, lambda: (100 + random.randint(-10, 10)).to_bytes(2, 'big')),
+    (0x710, 0.020, lambda: bytes([random.randint(0, 1)])),
+)
+
+# Attack senders in the style of can_attacks.py: rate (frames/s), frame generator
+ATTACKS = {
+    'flood': (2000, lambda: (next_id((0x000, 0x00F), False, 'random', None),
+                             rand_payload(8, 'zeros', None))),
+    'fuzz': (500, lambda: (next_id((0x000, 0x7FF), False, 'random', None),
+                           rand_payload(random.randint(0, 8), 'random', None))),
+    'spoof': (100, lambda: (0x330, rand_payload(2, 'ones', None))),
+}
+SCENARIOS = ('benign', 'flood', 'fuzz', 'spoof', 'mixed')
+BATCH_SIZES = (256, 1024)    # Batches for the batched detection stage
+
+# Sink name -> (database mode or None, alerts); 'summary' is the summary
+# persistence policy over the rows layout
+SINKS = {
+    'none': (None, False),
+    'db': ('rows', False),
+    'db-packed': ('packed', False),
+    'db-summary': ('summary', False),
+    'alerts': (None, True),
+    'db+alerts': ('rows', True),
+}
+
+
+def _sender(can_id, period, payload, start):
+    t = start + random.uniform(0, period)
+    while True:
+        yield t, can_id, payload()
+        t += period * random.uniform(0.98, 1.02)
+
+
+def _attacker(rate, frame, start):
+    t = start
+    while True:
+        can_id, data = frame()
+        yield t, can_id, data
+        t += 1.0 / rate
+
+
+def generate_traffic(scenario, frames, start=1000.0, seed=0):
+    """`frames` can.Message objects in timestamp order"""
+    random.seed(seed)
+    streams = [_sender(can_id, period, payload, start) for can_id, period, payload in BENIGN]
+    if scenario != 'benign':
+        for name, (rate, frame) in ATTACKS.items():
+            if scenario in (name, 'mixed'):
+                streams.append(_attacker(rate, frame, start))
+    return [can.Message(timestamp=t, arbitration_id=can_id, data=data,
+                        is_extended_id=can_id > 0x7FF)
+            for t, can_id, data in itertools.islice(heapq.merge(*streams), frames)]
+
+
+def build_ids(workdir, db=None, alerts=False, channel=None, learn_seconds=10.0):
+    """Quiet CANNetworkIDS with a baseline learned from benign traffic (db: SINKS mode)"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        ids = CANNetworkIDS(
+            channel=channel, interface='virtual', mqtt_broker=None,
+            db_path=os.path.join(workdir, 'bench.db') if db else None,
+            db_layout='packed' if db == 'packed' else 'rows',
+            persist='summary' if db == 'summary' else 'all',
+            alert_log=os.path.join(workdir, 'intrusions.log') if alerts else None)
+        ids.verbose = False
+        learned = set()
+        per_second = sum(1 / period for _, period, _ in BENIGN)
+        for msg in generate_traffic('benign', int(learn_seconds * per_second),
+                                    start=0.0, seed=1):
+            learned.add(msg.arbitration_id)
+            ids._learn_message(msg, msg.timestamp)
+        ids._finalize_baseline(learned)
+        ids.message_frequency.clear()
+    return ids
+
+
+def percentiles(samples_ns):
+    """p50/p99/p99.9 of a latency sample, in microseconds"""
+    p50, p99, p999 = (np.percentile(np.asarray(samples_ns), [50, 99, 99.9]) / 1000.0).tolist()
+    return {'p50_us': round(p50, 2), 'p99_us': round(p99, 2), 'p999_us': round(p999, 2)}
+
+
+def _timer_overhead():
+    clock = time.perf_counter_ns
+    samples = [-clock() + clock() for _ in range(10000)]
+    return int(np.median(samples))
+
+
+def bench_detectors(traffic, workdir):
+    """Per-check latency, plus the full per-frame and batched detection"""
+    results = []
+    overhead = _timer_overhead()
+    clock = time.perf_counter_ns
+
+    ids = build_ids(workdir)
+    checks = [(name, getattr(ids, method)) for name, method in ids.CHECKS.items()]
+    samples = {name: [] for name, _ in checks}
+    for msg in traffic:
+        can_id, now = msg.arbitration_id, msg.timestamp
+        ids._frequency_window(can_id, now).append(now)
+        for name, check in checks:
+            started = clock()
+            check(msg, can_id, now)
+            samples[name].append(clock() - started - overhead)
+    for name, _ in checks:
+        results.append(dict(stage=f"check:{name}", **percentiles(samples[name])))
+
+    ids = build_ids(workdir)
+    latencies = []
+    started_all = time.perf_counter()
+    for msg in traffic:
+        started = clock()
+        ids._frequency_window(msg.arbitration_id, msg.timestamp).append(msg.timestamp)
+        ids._detect_anomalies(msg, msg.timestamp)
+        latencies.append(clock() - started - overhead)
+    elapsed = time.perf_counter() - started_all
+    results.append(dict(stage='detect', frames_per_s=round(len(traffic) / elapsed),
+                        **percentiles(latencies)))
+
+    # Batched cost is a fixed number of array operations per batch plus
+    # per-ID bookkeeping, so throughput depends on the batch size
+    for batch_size in BATCH_SIZES:
+        ids = build_ids(workdir)
+        started_all = time.perf_counter()
+        per_frame = []
+        for start in range(0, len(traffic), batch_size):
+            messages = traffic[start:start + batch_size]
+            started = clock()
+            ids._detect_batch(FrameBatch(messages, [m.timestamp for m in messages]))
+            per_frame.append((clock() - started) / len(messages))
+        elapsed = time.perf_counter() - started_all
+        results.append(dict(stage=f"detect_batch[{batch_size}]",
+                            frames_per_s=round(len(traffic) / elapsed),
+                            **percentiles(per_frame)))
+    return results
+
+
+def bench_sinks(traffic, workdir, sinks=tuple(SINKS)):
+    """Detection plus persistence/alerting, fed in-process frame by frame"""
+    results = []
+    clock = time.perf_counter_ns
+    for sink in sinks:
+        db, alerts = SINKS[sink]
+
+        # Timed pass
+        ids = build_ids(workdir, db=db, alerts=alerts)
+        latencies = []
+        started_all = time.perf_counter()
+        for msg in traffic:
+            started = clock()
+            ids._process_message(msg, msg.timestamp)
+            latencies.append(clock() - started)
+        elapsed = time.perf_counter() - started_all
+        dropped = ids.db.dropped if ids.db is not None else 0
+        anomalies = ids.anomaly_count
+        with contextlib.redirect_stdout(io.StringIO()):
+            ids._cleanup()
+        size = {'db_kib': round(os.path.getsize(os.path.join(workdir, 'bench.db')) / 1024)} if db else {}
+
+        # Memory pass (tracemalloc slows everything down, so it runs separately)
+        ids = build_ids(workdir, db=db, alerts=alerts)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for msg in traffic:
+            ids._process_message(msg, msg.timestamp)
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ids._cleanup()
+
+        results.append(dict(stage=f"process+{sink}", frames_per_s=round(len(traffic) / elapsed),
+                            **percentiles(latencies), anomalies=anomalies, dropped=dropped,
+                            **size, mem_growth_kib=round((after - before) / 1024),
+                            mem_peak_kib=round((peak - before) / 1024)))
+        for name in ('bench.db', 'bench.db-wal', 'bench.db-shm', 'intrusions.log'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(workdir, name))
+    return results
+
+
+def _wrap_latency(ids, latencies, total, done):
+    """Record bus-to-verdict latency (frame timestamp to end of detection)"""
+    detect = ids._detect_anomalies
+
+    def timed(msg, now=None):
+        mask = detect(msg, now)
+        latencies.append(int((time.time() - msg.timestamp) * 1e9))
+        if len(latencies) == total:
+            done.append(time.perf_counter())
+        return mask
+    ids._detect_anomalies = timed
+
+
+def bench_virtual(traffic, workdir, runner, db='rows', rate=None, timeout=60.0):
+    """
+    End-to-end over python-can's virtual interface with a sender thread
+    rate paces the sender (frames/s); by default it sends as fast as it can,
+    so latencies then include the queueing of a saturated IDS.
+    """
+    channel = f"ids-bench-{runner}"
+    ids = build_ids(workdir, db=db, channel=channel)
+    total = len(traffic)
+    latencies, done = [], []
+    _wrap_latency(ids, latencies, total, done)
+    sender = can.interface.Bus(channel=channel, interface='virtual')
+
+    def send():
+        started = time.perf_counter()
+        for k, msg in enumerate(traffic):
+            if rate and k % 64 == 0:
+                delay = started + k / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sender.send(can.Message(arbitration_id=msg.arbitration_id, data=msg.data,
+                                    is_extended_id=msg.is_extended_id))
+
+    deadline = time.monotonic() + timeout
+    finished = lambda: done or time.monotonic() > deadline
+    feeder = threading.Thread(target=send, daemon=True)
+    drops = 0
+    started = time.perf_counter()
+
+    if runner == 'loop':
+        feeder.start()
+        while not finished():
+            msg = ids.bus.recv(timeout=0.1)
+            if msg is None:
+                if not feeder.is_alive():
+                    break
+                continue
+            ids._process_message(msg)
+    elif runner == 'pipelined':
+        pipeline = IDSPipeline(ids)
+        pipeline.start()
+        feeder.start()
+        while not finished():
+            if not feeder.is_alive() and pipeline.received >= total and \
+                    len(pipeline.detect.queue) == 0:
+                break
+            time.sleep(0.001)
+        pipeline.stop()    # Drains whatever the stages still hold
+        drops = sum(stage.queue.dropped for stage in pipeline.stages)
+    elif runner == 'async':
+        async_ids = AsyncIDS([ids])
+
+        async def drive():
+            serve = asyncio.create_task(async_ids.serve())
+            await asyncio.sleep(0.05)
+            feeder.start()
+            while not finished():
+                reader = async_ids.readers.get(channel)
+                if reader is not None and not feeder.is_alive() and \
+                        reader.received + reader.dropped >= total and \
+                        ids.message_count >= reader.received:
+                    break
+                await asyncio.sleep(0.001)
+            serve.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await serve
+        asyncio.run(drive())
+        drops = sum(reader.dropped for reader in async_ids.readers.values())
+    else:
+        raise ValueError(f"Unknown runner: {runner}")
+
+    # Throughput up to the last verdict, not including runner shutdown
+    elapsed = (done[0] if done else time.perf_counter()) - started
+    feeder.join()
+    dropped_rows = ids.db.dropped if ids.db is not None else 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        ids._cleanup()
+    sender.shutdown()
+    result = dict(stage=f"virtual:{runner}", frames_per_s=round(ids.message_count / elapsed),
+                  inspected=ids.message_count, sent=total, dropped=drops + dropped_rows)
+    if latencies:
+        result.update(percentiles(latencies))
+    return result
+
+
+def print_table(results):
+    columns = ['stage', 'frames_per_s', 'p50_us', 'p99_us', 'p999_us', 'anomalies',
+               'inspected', 'dropped', 'db_kib', 'mem_growth_kib', 'mem_peak_kib']
+    columns = [c for c in columns if any(c in row for row in results)]
+    widths = {c: max(len(c), *(len(str(row.get(c, ''))) for row in results)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in results:
+        print("  ".join(str(row.get(c, '')).ljust(widths[c]) for c in columns))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Throughput/latency benchmark for the CAN Network IDS",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--frames", type=int, default=50000, help="Frames per run")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mixed",
+                        help="Traffic mix: benign periodic senders plus attack generators")
+    parser.add_argument("--sinks", nargs="+", choices=tuple(SINKS), default=list(SINKS),
+                        help="Sink combinations for the in-process runs")
+    parser.add_argument("--virtual", nargs="*", choices=('loop', 'pipelined', 'async'), default=None,
+                        help="Also run end-to-end over the virtual interface with these runners "
+                             "(all if none given)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Pace the virtual-interface sender at this many frames/s (default: unpaced)")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    traffic = generate_traffic(args.scenario, args.frames)
+    print(f"{args.frames} frames, scenario '{args.scenario}', "
+          f"{traffic[-1].timestamp - traffic[0].timestamp:.1f}s of simulated traffic")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = bench_detectors(traffic, workdir)
+        results += bench_sinks(traffic, workdir, args.sinks)
+        if args.virtual is not None:
+            for runner in args.virtual or ('loop', 'pipelined', 'async'):
+                results.append(bench_virtual(traffic, workdir, runner, rate=args.rate))
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'frames': args.frames, 'scenario': args.scenario,
+                       'results': results}, f, indent=2)
@@ -0,0 +1,116 @@
+"""
+Pre/post-trigger capture for the CAN Network IDS
+A fixed ring of the most recent frames per bus, written out as a candump log
+around each anomaly (the seconds before it and the seconds after)
+"""
+
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+from storage import FLAG_EXTENDED, FRAME_DTYPE, PACKED_RECORD, PARTITION_TIME
+
+
+class CaptureRing:
+    """
+    Ring buffer of the last frames of one bus, dumped around anomalies
+    Frames are packed into a preallocated array of `capacity` 24-byte
+    records. An anomaly opens a capture holding the `pre_seconds` before it
+    and everything up to `post_seconds` after the last anomaly it covers
+    (at most `max_seconds` in total). Captures are candump -l logs, written
+    by a background thread; --replay reads them back.
+    """
+
+    def __init__(self, channel, directory='captures', pre_seconds=5.0, post_seconds=5.0,
+                 capacity=65536, max_seconds=60.0):
+        self.channel = channel or 'offline'
+        self.directory = directory
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.capacity = capacity
+        self.max_seconds = max_seconds
+        self._records = bytearray(capacity * PACKED_RECORD.size)    # 24 bytes per frame
+        self._frames = np.frombuffer(self._records, dtype=FRAME_DTYPE)
+        self._pack = PACKED_RECORD.pack_into
+        self.seq = 0                 # Frames recorded; slot of frame n is n % capacity
+        self._written = 0            # Frames before this one were dumped already
+        self._path = None            # Open capture (None: not capturing)
+        self._started = None
+        self._end = None
+        self._next = 0               # First frame of the open capture not yet handed out
+        self._tasks = queue.Queue()
+        self._writer = threading.Thread(target=self._write, name='ids-capture', daemon=True)
+        self._writer.start()
+
+        # Statistics
+        self.captures = 0
+        self.frames_captured = 0
+
+    def record(self, msg, timestamp, is_anomaly):
+        """Add one inspected frame; an anomalous one triggers (or extends) a capture"""
+        seq = self.seq
+        if self._path is not None:
+            if timestamp > self._end:
+                self._close(seq)
+            elif seq - self._next >= self.capacity // 2:
+                self._flush(seq)    # Hand out frames before the ring overwrites them
+        # flags: FLAG_ANOMALY | FLAG_EXTENDED; '8s' pads or truncates the payload
+        self._pack(self._records, (seq % self.capacity) * 24, timestamp, msg.arbitration_id,
+                   msg.dlc, is_anomaly | (msg.is_extended_id << 1), msg.data)
+        self.seq = seq + 1
+        if is_anomaly:
+            self._trigger(timestamp)
+
+    def _trigger(self, timestamp):
+        if self._path is not None:
+            self._end = min(max(self._end, timestamp + self.post_seconds),
+                            self._started + self.max_seconds)
+            return
+        # First buffered frame of the pre-trigger window not in an earlier capture
+        oldest = max(self.seq - self.capacity, self._written)
+        times = self._frames['timestamp'][np.arange(oldest, self.seq) % self.capacity]
+        self._next = oldest + int(np.argmax(times >= timestamp - self.pre_seconds))
+        self._started = timestamp
+        self._end = timestamp + self.post_seconds
+        start = datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime(PARTITION_TIME)
+        self._path = os.path.join(self.directory, f"{self.channel}-{start}-{self.captures}.log")
+        self.captures += 1
+
+    def _flush(self, upto):
+        """Hand frames [_next, upto) of the open capture to the writer thread"""
+        if upto > self._next:
+            frames = self._frames[np.arange(self._next, upto) % self.capacity]    # A copy
+            self._tasks.put((self._path, frames))
+            self.frames_captured += len(frames)
+            self._next = upto
+
+    def _close(self, upto):
+        self._flush(upto)
+        self._written = upto
+        self._path = None
+
+    def _write(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            path, frames = task
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'a') as f:
+                f.writelines(self._format(frames))
+
+    def _format(self, frames):
+        """candump -l lines: (timestamp) channel ID#DATA"""
+        for timestamp, can_id, dlc, flags, _, data in frames.tolist():
+            ident = f"{can_id:08X}" if flags & FLAG_EXTENDED else f"{can_id:03X}"
+            yield f"({timestamp:.6f}) {self.channel} {ident}#{bytes(data[:dlc]).hex().upper()}\n"
+
+    def close(self):
+        """Write out an open capture (cut short) and stop the writer"""
+        if self._path is not None:
+            self._close(self.seq)
+        self._tasks.put(None)
+        self._writer.join()
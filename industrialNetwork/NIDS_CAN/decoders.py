@@ -0,0 +1,70 @@
+"""
+Payload field decoders for the CAN Network IDS
+Declarative field specs compiled once into struct / NumPy decoders
+"""
+
+import math
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# Where a physical value lives in the payload: physical = raw * scale
+FieldSpec = namedtuple('FieldSpec', 'offset width byteorder signed scale',
+                       defaults=(0, 1, 'big', False, 1.0))
+
+MAX_PAYLOAD = 8
+
+_STRUCT_CODES = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+
+class PayloadDecoder:
+    """Decode one FieldSpec from single payloads or from a payload matrix"""
+
+    def __init__(self, spec=None):
+        spec = spec or FieldSpec()
+        if spec.width not in _STRUCT_CODES:
+            raise ValueError(f"Unsupported field width: {spec.width}")
+        if spec.byteorder not in ('big', 'little'):
+            raise ValueError(f"Unknown byte order: {spec.byteorder}")
+        if spec.scale <= 0:
+            raise ValueError(f"Field scale must be positive: {spec.scale}")
+
+        if spec.offset < 0 or spec.offset + spec.width > MAX_PAYLOAD:
+            raise ValueError(f"Field does not fit in a {MAX_PAYLOAD}-byte payload: {spec}")
+
+        self.spec = spec
+        self.offset = spec.offset
+        self.end = spec.offset + spec.width      # Minimum payload length
+
+        code = _STRUCT_CODES[spec.width]
+        code = code if spec.signed else code.upper()
+        order = '>' if spec.byteorder == 'big' else '<'
+        self._unpack_from = struct.Struct(order + code).unpack_from
+        self.dtype = np.dtype(f"{order}{'i' if spec.signed else 'u'}{spec.width}")
+
+    def raw_bounds(self, val_min, val_max):
+        """Physical-unit bounds converted once into raw integer bounds"""
+        scale = self.spec.scale
+        return math.ceil(val_min / scale - 1e-9), math.floor(val_max / scale + 1e-9)
+
+    def decode_raw(self, data):
+        """Raw field value of one payload, or None if the payload is too short"""
+        if len(data) < self.end:
+            return None
+        return self._unpack_from(data, self.offset)[0]
+
+    def decode(self, data):
+        """Physical value of one payload, or None if the payload is too short"""
+        raw = self.decode_raw(data)
+        return None if raw is None else raw * self.spec.scale
+
+    def decode_raw_batch(self, payloads, dlcs):
+        """Raw field values of an (N, 8) uint8 payload matrix
+
+        Returns (values, valid) where `valid` marks frames long enough to
+        carry the field.
+        """
+        field = np.ascontiguousarray(payloads[:, self.offset:self.end])
+        values = field.view(self.dtype).reshape(-1)
+        return values, dlcs >= self.end
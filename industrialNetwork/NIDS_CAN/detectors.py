@@ -0,0 +1,643 @@
+"""
+Per-ID detector state for the CAN Network IDS
+Fixed-size models learned from baseline traffic and queried per frame
+"""
+
+import math
+import random
+from bisect import bisect_right
+from collections import deque, namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from anomalies import PAYLOAD_TRANSITION, PAYLOAD_VALUE
+from decoders import PayloadDecoder
+
+MAX_DLC = 8
+STANDARD_ID_SPACE = 0x800    # 11-bit identifiers
+
+# Payload profiles: byte transition tables are indexed by prev << 8 | value
+ENUM_VALUES = 16             # Most distinct values of an enumerated byte position
+LENGTH_BITS = tuple((1 << 8 * n) - 1 for n in range(MAX_DLC + 1))    # Payload length -> bit mask
+_BAD_VALUE, _BAD_TRANSITION = 1, 2                                    # Transition table codes
+TABLE_SIZE = 256 * 256
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+# Value bounds are physical units; raw bounds are the same bounds pre-divided
+# by the field scale so per-frame checks compare integers only
+SensorRange = namedtuple('SensorRange',
+                         'name id_min id_max val_min val_max decoder raw_min raw_max')
+
+
+def compile_sensor_range(name, spec):
+    """Build a SensorRange from (id_min, id_max, val_min, val_max[, FieldSpec])"""
+    id_min, id_max, val_min, val_max = spec[:4]
+    decoder = PayloadDecoder(spec[4] if len(spec) > 4 else None)
+    raw_min, raw_max = decoder.raw_bounds(val_min, val_max)
+    return SensorRange(name, id_min, id_max, val_min, val_max,
+                       decoder, raw_min, raw_max)
+
+
+class PayloadStats:
+    """Running per-byte payload statistics for one CAN ID (Welford)"""
+
+    __slots__ = ('samples', 'count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.samples = 0                 # Frames folded into the model
+        self.count = [0] * MAX_DLC       # Samples seen per byte position
+        self.mean = [0.0] * MAX_DLC
+        self.m2 = [0.0] * MAX_DLC        # Sum of squared deviations
+        self.min = [255] * MAX_DLC
+        self.max = [0] * MAX_DLC
+
+    def update(self, data):
+        """Fold one payload into the running statistics"""
+        self.samples += 1
+        count, mean, m2 = self.count, self.mean, self.m2
+        for i, value in enumerate(data[:MAX_DLC]):
+            n = count[i] + 1
+            count[i] = n
+            delta = value - mean[i]
+            mean[i] += delta / n
+            m2[i] += delta * (value - mean[i])
+            if value < self.min[i]:
+                self.min[i] = value
+            if value > self.max[i]:
+                self.max[i] = value
+
+    def variance(self, position):
+        """Sample variance of one byte position"""
+        n = self.count[position]
+        return self.m2[position] / (n - 1) if n > 1 else 0.0
+
+    def deviation(self, data):
+        """Mean absolute deviation of a payload from the learned mean pattern"""
+        total = 0.0
+        positions = 0
+        count, mean = self.count, self.mean
+        for i, value in enumerate(data[:MAX_DLC]):
+            if count[i]:
+                total += abs(value - mean[i])
+                positions += 1
+        return total / positions if positions else 0.0
+
+
+@lru_cache(maxsize=None)
+def step_table(limit):
+    """Transition table accepting a circular step of at most `limit`"""
+    prev, value = np.divmod(np.arange(TABLE_SIZE), 256)
+    step = (value - prev) % 256
+    return bytes((np.minimum(step, 256 - step) > limit).astype(np.uint8) * _BAD_TRANSITION)
+
+
+@lru_cache(maxsize=None)
+def enum_table(values, transitions):
+    """Transition table accepting `values` (frozenset) reached by `transitions`
+
+    transitions holds prev << 8 | value pairs; repeating a value is always
+    accepted. Identical tables of different IDs are shared.
+    """
+    row = bytearray([_BAD_VALUE]) * 256
+    for value in values:
+        row[value] = _BAD_TRANSITION
+    table = row * 256
+    for value in values:
+        table[value << 8 | value] = 0
+    for pair in transitions:
+        table[pair] = 0
+    return bytes(table)
+
+
+class PayloadProfile:
+    """Learned byte-level structure of one CAN ID's payloads
+
+    Learning keeps, per byte position, a value histogram, the largest
+    frame-to-frame step and (while few enough) the value transitions seen,
+    plus AND/OR accumulators of whole payloads. finalize() compiles them
+    into lookup tables: a 64-bit constant-bit mask and, per checked byte
+    position, a 64 KiB table indexed by (previous value, value), so check()
+    is one table lookup per byte.
+    """
+
+    __slots__ = ('samples', 'histogram', 'max_step', 'transitions', 'and_bits', 'or_bits',
+                 'entropy', 'const_mask', 'const_value', 'bit_tolerance', 'rules', 'last',
+                 '_previous')
+
+    def __init__(self):
+        self.samples = 0                                    # Frames learned
+        self.histogram = [[0] * 256 for _ in range(MAX_DLC)]
+        self.max_step = [0] * MAX_DLC                       # Largest circular change
+        # prev << 8 | value pairs; None once a position has too many
+        self.transitions = [set() for _ in range(MAX_DLC)]
+        self.and_bits = LENGTH_BITS[MAX_DLC]                # Little-endian payloads
+        self.or_bits = 0
+        self._previous = None
+
+        # Compiled by finalize()
+        self.entropy = [0.0] * MAX_DLC        # Shannon entropy (bits) per position
+        self.const_mask = 0                   # Bits that never changed
+        self.const_value = 0
+        self.bit_tolerance = 0                # Constant bits a frame may flip
+        self.rules = ()                       # (position, transition table)
+        self.last = None                      # Previous payload without value anomalies
+
+    def learn(self, data):
+        """Fold one benign payload into the profile"""
+        data = bytes(data[:MAX_DLC])
+        self.samples += 1
+        previous, self._previous = self._previous, data
+        value = int.from_bytes(data, 'little')
+        self.and_bits &= value
+        self.or_bits |= value
+        for i, byte in enumerate(data):
+            self.histogram[i][byte] += 1
+            if previous is None or i >= len(previous):
+                continue
+            step = (byte - previous[i]) % 256
+            self.max_step[i] = max(self.max_step[i], min(step, 256 - step))
+            pairs = self.transitions[i]
+            if pairs is not None:
+                pairs.add(previous[i] << 8 | byte)
+                if len(pairs) > ENUM_VALUES * ENUM_VALUES:
+                    self.transitions[i] = None
+
+    def finalize(self, min_samples=50, entropy_limit=2.0, step_margin=2.0, bit_tolerance=2):
+        """
+        Compile the lookup tables
+        Positions with 2..ENUM_VALUES values and at most entropy_limit bits
+        of entropy only accept learned values and transitions; others accept
+        steps up to step_margin times the largest learned one. Profiles of
+        fewer than min_samples frames check nothing.
+        """
+        self._previous = None
+        self.last = None
+        self.rules = ()
+        self.const_mask = 0
+        totals = [sum(counts) for counts in self.histogram]
+        for i, total in enumerate(totals):
+            counts = self.histogram[i]
+            self.entropy[i] = sum(c / total * math.log2(total / c)
+                                  for c in counts if c) if total else 0.0
+        if self.samples < min_samples:
+            return
+
+        length = max((i + 1 for i, total in enumerate(totals) if total), default=0)
+        self.const_mask = ~(self.and_bits ^ self.or_bits) & LENGTH_BITS[length]
+        self.const_value = self.and_bits & self.const_mask
+        self.bit_tolerance = bit_tolerance
+
+        rules = []
+        for i in range(length):
+            seen = [value for value, count in enumerate(self.histogram[i]) if count]
+            if len(seen) < 2:
+                continue    # Constant bytes are covered by const_mask
+            pairs = self.transitions[i]
+            if (len(seen) <= ENUM_VALUES and self.entropy[i] <= entropy_limit
+                    and pairs is not None):
+                rules.append((i, enum_table(frozenset(seen), frozenset(pairs))))
+                continue
+            limit = math.ceil(self.max_step[i] * step_margin)
+            if limit < 128:
+                rules.append((i, step_table(limit)))
+        self.rules = tuple(rules)
+
+    def check(self, data):
+        """
+        Anomaly bits of one payload: PAYLOAD_VALUE, PAYLOAD_TRANSITION or 0
+        Transitions need a previous payload of the same length: the first
+        frame (and one after a length change) only has its values checked.
+        """
+        n = len(data)
+        if n > MAX_DLC:
+            data, n = data[:MAX_DLC], MAX_DLC
+        flipped = (int.from_bytes(data, 'little') ^ self.const_value) & self.const_mask
+        flipped &= LENGTH_BITS[n]
+        # Hamming distance of the constant part, as in the PIC32MZ gateway
+        if flipped and bin(flipped).count('1') > self.bit_tolerance:
+            return PAYLOAD_VALUE
+        last = self.last
+        primed = last is not None and len(last) == n
+        found = 0
+        for position, table in self.rules:
+            if position >= n:
+                break
+            # Unlearned values are _BAD_VALUE in every row, row 0 included
+            code = table[last[position] << 8 | data[position] if primed else data[position]]
+            if code == _BAD_VALUE:
+                return PAYLOAD_VALUE    # Not kept as the reference for transitions
+            found |= code
+        self.last = data
+        return PAYLOAD_TRANSITION if found and primed else 0
+
+
+class RateWindow:
+    """Sliding-window message rate for one CAN ID with bounded memory"""
+
+    __slots__ = ('window', 'times', 'total', 'first', 'last')
+
+    def __init__(self, window=1.0, capacity=101):
+        self.window = window
+        # Only the newest `capacity` timestamps are kept: once the window
+        # holds that many, the rate is already above any threshold below it.
+        self.times = deque(maxlen=capacity)
+        self.total = 0       # Lifetime message count
+        self.first = None    # Lifetime first/last timestamps
+        self.last = None
+
+    def append(self, timestamp):
+        """Record one message arrival"""
+        self.times.append(timestamp)
+        self.total += 1
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+
+    def resize(self, capacity):
+        """Change the cap, keeping the newest timestamps"""
+        if capacity != self.times.maxlen:
+            self.times = deque(self.times, maxlen=capacity)
+
+    def count(self, now):
+        """Messages seen in the window ending at `now` (capped at capacity)"""
+        times = self.times
+        horizon = now - self.window
+        while times and times[0] <= horizon:
+            times.popleft()
+        return len(times)
+
+    def mean_interval(self):
+        """Average inter-arrival time over the lifetime of the window"""
+        if self.total < 2:
+            return None
+        return (self.last - self.first) / (self.total - 1)
+
+
+class InterArrivalModel:
+    """Learned inter-arrival distribution of one periodic CAN ID
+
+    Learning keeps Welford moments plus a fixed-size reservoir of intervals
+    for percentiles; finalize() turns them into early/late bounds that
+    check() applies to each new frame in constant time.
+    """
+
+    __slots__ = ('last', 'count', 'mean', 'm2', 'p_low', 'p_high',
+                 'lower', 'upper', '_reservoir', '_seen')
+
+    RESERVOIR_SIZE = 512
+
+    def __init__(self):
+        self.last = None
+        self.count = 0           # Intervals learned
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.p_low = None        # Learned interval percentiles
+        self.p_high = None
+        self.lower = None        # Early/late bounds (None until finalized)
+        self.upper = None
+        self._reservoir = []
+        self._seen = 0
+
+    @property
+    def jitter(self):
+        """Standard deviation of the learned intervals"""
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def learn(self, timestamp):
+        """Fold the interval ending at `timestamp` into the model"""
+        last, self.last = self.last, timestamp
+        if last is None:
+            return
+        interval = timestamp - last
+        self.count += 1
+        delta = interval - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (interval - self.mean)
+
+        # Reservoir sampling keeps memory fixed however long the warm-up is
+        self._seen += 1
+        if len(self._reservoir) < self.RESERVOIR_SIZE:
+            self._reservoir.append(interval)
+        else:
+            slot = random.randrange(self._seen)
+            if slot < self.RESERVOIR_SIZE:
+                self._reservoir[slot] = interval
+
+    def finalize(self, k=4.0, tolerance=0.1, min_samples=10,
+                 low_percentile=1, high_percentile=99):
+        """Derive detection bounds from what was learned"""
+        if self._reservoir:
+            self.p_low, self.p_high = (float(p) for p in np.percentile(
+                self._reservoir, (low_percentile, high_percentile)))
+        self._reservoir = []
+        self._seen = 0
+        self.last = None        # The next frame only primes the detector
+        if self.count < min_samples:
+            self.lower = self.upper = None
+            return
+        spread = k * self.jitter
+        self.lower = max(0.0, min(self.p_low, self.mean - spread) * (1 - tolerance))
+        self.upper = max(self.p_high, self.mean + spread) * (1 + tolerance)
+
+    def check(self, timestamp):
+        """-1 if the frame came too early, 1 if too late, else 0"""
+        last, self.last = self.last, timestamp
+        if last is None or self.lower is None:
+            return 0
+        interval = timestamp - last
+        if interval < self.lower:
+            return -1
+        if interval > self.upper:
+            return 1
+        return 0
+
+
+class SensorLookup:
+    """CAN ID -> SensorRange table compiled once from a sensor_ranges mapping
+
+    Standard IDs are resolved with a direct-indexed 2048-entry table, extended
+    IDs with a binary search over disjoint intervals. Where ranges overlap the
+    first declared range wins; the overlaps are kept in `self.overlaps`.
+    """
+
+    def __init__(self, sensor_ranges):
+        self.table = [None] * STANDARD_ID_SPACE
+        self.overlaps = []           # (first_name, second_name, id_lo, id_hi)
+        segments = []                # Disjoint (id_min, id_max, entry), sorted
+
+        entries = [compile_sensor_range(name, spec)
+                   for name, spec in sensor_ranges.items()]
+        self.entries = entries
+        # Entry index per standard ID (-1 = not a sensor) for batch grouping
+        self.index_table = np.full(STANDARD_ID_SPACE, -1, dtype=np.int16)
+        for i, entry in enumerate(entries):
+            for earlier in entries[:i]:
+                lo = max(entry.id_min, earlier.id_min)
+                hi = min(entry.id_max, earlier.id_max)
+                if lo <= hi:
+                    self.overlaps.append((earlier.name, entry.name, lo, hi))
+            for lo, hi in self._uncovered(segments, entry.id_min, entry.id_max):
+                segments.append((lo, hi, entry))
+                for can_id in range(lo, min(hi, STANDARD_ID_SPACE - 1) + 1):
+                    self.table[can_id] = entry
+                    self.index_table[can_id] = i
+            segments.sort(key=lambda seg: seg[0])
+
+        # Only intervals reaching past the 11-bit space need the fallback
+        self._extended = [seg for seg in segments if seg[1] >= STANDARD_ID_SPACE]
+        self._extended_starts = [seg[0] for seg in self._extended]
+
+    @staticmethod
+    def _uncovered(segments, lo, hi):
+        """Parts of [lo, hi] not already claimed by an earlier range"""
+        gaps = []
+        for seg_lo, seg_hi, _ in segments:
+            if seg_hi < lo or seg_lo > hi:
+                continue
+            if seg_lo > lo:
+                gaps.append((lo, seg_lo - 1))
+            lo = max(lo, seg_hi + 1)
+            if lo > hi:
+                return gaps
+        gaps.append((lo, hi))
+        return gaps
+
+    def lookup(self, can_id):
+        """Sensor range covering `can_id`, or None"""
+        if can_id < STANDARD_ID_SPACE:
+            return self.table[can_id]
+        i = bisect_right(self._extended_starts, can_id) - 1
+        if i >= 0:
+            lo, hi, entry = self._extended[i]
+            if can_id <= hi:
+                return entry
+        return None
+
+    def validate_batch(self, ids, dlcs, payloads, lengths=None):
+        """Vectorised range check of a batch of frames
+
+        `ids` and `dlcs` are length-N integer arrays and `payloads` an (N, 8)
+        uint8 matrix; `lengths` (payload byte counts) defaults to `dlcs`.
+        Returns boolean arrays (invalid_data, out_of_range).
+        """
+        lengths = dlcs if lengths is None else lengths
+        n = len(ids)
+        invalid = np.zeros(n, dtype=bool)
+        out_of_range = np.zeros(n, dtype=bool)
+
+        standard = ids < STANDARD_ID_SPACE
+        entry_idx = np.full(n, -1, dtype=np.int16)
+        entry_idx[standard] = self.index_table[ids[standard]]
+        for j in np.flatnonzero(~standard):
+            entry = self.lookup(int(ids[j]))
+            if entry is not None:
+                entry_idx[j] = self.entries.index(entry)
+        # Frames without payload are not range-checked (as in the per-frame path)
+        entry_idx[dlcs < 1] = -1
+
+        for k in np.unique(entry_idx[entry_idx >= 0]):
+            entry = self.entries[k]
+            rows = np.flatnonzero(entry_idx == k)
+            values, valid = entry.decoder.decode_raw_batch(payloads[rows], lengths[rows])
+            invalid[rows] = ~valid
+            out_of_range[rows] = valid & ((values < entry.raw_min) |
+                                          (values > entry.raw_max))
+        return invalid, out_of_range
+
+
+class PayloadLookup:
+    """CAN ID -> PayloadProfile compiled once into arrays for batch checks
+
+    Constant-bit masks and the offsets of each position's transition table
+    in one stacked table array are kept per profile row. Row 0 (and the
+    all-zero table 0) stand for IDs without a profile, so check_batch() is
+    the same few array operations however many IDs a batch holds. The
+    previous payload stays in each profile's `last`, shared with check().
+    """
+
+    def __init__(self, profiles):
+        self.rows = {}                # CAN ID -> row
+        self.profiles = [None]
+        const_mask, const_value = [bytes(MAX_DLC)], [bytes(MAX_DLC)]
+        tolerance, offsets = [0], [[0] * MAX_DLC]
+        slots = {bytes(TABLE_SIZE): 0}    # Table -> index in the stacked array
+        for can_id, profile in profiles.items():
+            self.rows[can_id] = len(self.profiles)
+            self.profiles.append(profile)
+            const_mask.append(profile.const_mask.to_bytes(MAX_DLC, 'little'))
+            const_value.append(profile.const_value.to_bytes(MAX_DLC, 'little'))
+            tolerance.append(profile.bit_tolerance)
+            row = [0] * MAX_DLC
+            for position, table in profile.rules:
+                row[position] = slots.setdefault(table, len(slots)) * TABLE_SIZE
+            offsets.append(row)
+        self.const_mask = np.frombuffer(b''.join(const_mask), np.uint8).reshape(-1, MAX_DLC)
+        self.const_value = np.frombuffer(b''.join(const_value), np.uint8).reshape(-1, MAX_DLC)
+        self.tolerance = np.array(tolerance)
+        self.offsets = np.array(offsets, dtype=np.intp)
+        self.tables = np.frombuffer(b''.join(slots), np.uint8)
+
+    def check_batch(self, ids, groups, payloads, lengths):
+        """
+        PayloadProfile.check for every frame of a batch
+        ids are the CAN IDs of groups.ids; returns anomaly bits per frame in
+        batch row order.
+        """
+        rows = [self.rows.get(can_id, 0) for can_id in ids]
+        profiled = [(u, r) for u, r in enumerate(rows) if r]
+        group = groups.inverse[groups.order]    # Frames ID by ID, in arrival order
+        data = payloads[groups.order]
+        length = lengths[groups.order]
+        row = np.array(rows, dtype=np.intp)[group]
+        present = np.arange(MAX_DLC) < length[:, None]
+        offsets = self.offsets[row]
+
+        # Constant bits and values do not depend on the previous frame
+        flipped = (data ^ self.const_value[row]) & self.const_mask[row] * present
+        bad = POPCOUNT[flipped].sum(axis=1) > self.tolerance[row]
+        bad |= ((self.tables[offsets + data] == _BAD_VALUE) & present).any(axis=1)
+
+        # Transitions from the latest earlier frame of the ID without value
+        # anomalies, or from the profile's `last` when the batch has none
+        position = np.arange(len(group))
+        latest = np.maximum.accumulate(np.where(bad, -1, position))
+        previous = np.concatenate(([-1], latest[:-1]))
+        inherited = previous < groups.starts[group]
+        last_data = np.zeros((len(rows), MAX_DLC), dtype=np.uint8)
+        last_length = np.full(len(rows), -1)
+        for u, r in profiled:
+            last = self.profiles[r].last
+            if last is not None:
+                last_data[u, :len(last)] = memoryview(last)
+                last_length[u] = len(last)
+        previous_data = np.where(inherited[:, None], last_data[group], data[previous])
+        primed = ~bad & (np.where(inherited, last_length[group], length[previous]) == length)
+        codes = self.tables[offsets + (previous_data.astype(np.intp) << 8 | data)]
+        transition = primed & ((codes != 0) & present).any(axis=1)
+
+        newest = latest[groups.ends - 1].tolist()
+        starts = groups.starts.tolist()
+        for u, r in profiled:
+            k = newest[u]
+            if k >= starts[u]:
+                self.profiles[r].last = data[k, :length[k]].tobytes()
+        out = np.empty(len(group), dtype=np.uint16)
+        out[groups.order] = np.where(bad, PAYLOAD_VALUE, transition * PAYLOAD_TRANSITION)
+        return out
+
+
+class FrameBatch:
+    """Columnar view of a list of CAN messages"""
+
+    __slots__ = ('timestamps', 'ids', 'dlcs', 'lengths', 'payloads')
+
+    def __init__(self, messages, timestamps):
+        n = len(messages)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.ids = np.fromiter((m.arbitration_id for m in messages),
+                               dtype=np.uint32, count=n)
+        self.dlcs = np.fromiter((m.dlc for m in messages), dtype=np.int16, count=n)
+        data = [bytes(m.data[:MAX_DLC]) for m in messages]
+        self.lengths = np.fromiter(map(len, data), dtype=np.int16, count=n)
+        self.payloads = np.frombuffer(b''.join(d.ljust(MAX_DLC, b'\0') for d in data),
+                                      dtype=np.uint8).reshape(n, MAX_DLC)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class IdGroups:
+    """Rows of a FrameBatch grouped by CAN ID, in arrival order within each ID"""
+
+    __slots__ = ('ids', 'inverse', 'counts', 'order', 'starts', 'ends')
+
+    def __init__(self, ids):
+        self.ids, self.inverse, self.counts = np.unique(ids, return_inverse=True,
+                                                        return_counts=True)
+        self.order = np.argsort(self.inverse, kind='stable')    # Batch rows, ID by ID
+        self.ends = np.cumsum(self.counts)
+        self.starts = self.ends - self.counts
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def exceeds_rate(windows, groups, timestamps, threshold):
+    """
+    RateWindow.append, then count > threshold, for every frame of a batch
+    windows[u] is the window of groups.ids[u]; returns a boolean per frame
+    in batch row order.
+    """
+    times = timestamps[groups.order].tolist()
+    starts, ends = groups.starts.tolist(), groups.ends.tolist()
+    axis, held, busy = [], [], []
+    for u, rate in enumerate(windows):
+        arrivals = times[starts[u]:ends[u]]
+        # Only windows that may pass the threshold within the batch are counted
+        if len(rate.times) + len(arrivals) > threshold:
+            rate.count(arrivals[0])    # Drops what no frame of the batch can count
+            busy.append(u)
+            held.append(len(rate.times))
+            axis.extend(rate.times)
+            axis.extend(arrivals)
+        rate.times.extend(arrivals)
+        rate.total += len(arrivals)
+        if rate.first is None:
+            rate.first = arrivals[0]
+        rate.last = arrivals[-1]
+    out = np.zeros(len(times), dtype=bool)
+    if not busy:
+        return out
+    window = np.array([windows[u].window for u in busy])
+    capacity = np.array([windows[u].times.maxlen for u in busy])
+    frames = groups.counts[busy]
+    held = np.array(held)
+
+    # One sorted axis for these IDs: the k-th one's timestamps (still
+    # buffered, then its frames) shifted by k * stride, so a single
+    # searchsorted counts every window
+    axis = np.array(axis)
+    origin = axis.min() - window.max()
+    stride = axis.max() - origin + 1.0
+    axis += np.repeat(np.arange(len(busy)) * stride, held + frames) - origin
+    group = np.repeat(np.arange(len(busy)), frames)
+    slots = np.arange(len(group)) + np.repeat(np.cumsum(held), frames)
+    counts = slots + 1 - np.searchsorted(axis, axis[slots] - window[group], side='right')
+    selected = np.zeros(len(groups), dtype=bool)
+    selected[busy] = True
+    out[groups.order[np.repeat(selected, groups.counts)]] = (
+        np.minimum(counts, capacity[group]) > threshold)
+    return out
+
+
+def check_intervals(models, groups, timestamps):
+    """
+    InterArrivalModel.check for every frame of a batch
+    models[u] is the model of groups.ids[u] or None. Returns -1/0/1 per
+    frame in batch row order.
+    """
+    times = timestamps[groups.order]
+    arrivals = times.tolist()
+    starts, ends = groups.starts.tolist(), groups.ends.tolist()
+    previous = np.empty_like(times)
+    previous[1:] = times[:-1]
+    first = np.full(len(groups), np.nan)    # NaN intervals and bounds never trigger
+    lower = np.full(len(groups), np.nan)
+    upper = np.full(len(groups), np.nan)
+    for u, model in enumerate(models):
+        if model is None:
+            continue
+        if model.last is not None:
+            first[u] = model.last
+        if model.lower is not None:
+            lower[u], upper[u] = model.lower, model.upper
+        model.last = arrivals[ends[u] - 1]
+    previous[starts] = first
+    group = groups.inverse[groups.order]
+    interval = times - previous
+    early = interval < lower[group]
+    late = ~early & (interval > upper[group])
+    out = np.empty(len(times), dtype=np.int8)
+    out[groups.order] = late.astype(np.int8) - early
+    return out
@@ -0,0 +1,145 @@
+"""
+Kernel acceptance filters for the CAN Network IDS
+Allow/deny ID configuration compiled to python-can can_filters, plus an
+unfiltered counting-only receiver for frames the filters keep out of Python
+"""
+
+import threading
+from collections import Counter
+
+import can
+
+STANDARD_ID_MAX = 0x7FF
+EXTENDED_ID_MAX = 0x1FFFFFFF
+
+
+def _intervals(entries):
+    """Normalise IDs and (low, high) ranges into sorted, merged intervals"""
+    spans = []
+    for entry in entries:
+        low, high = entry if isinstance(entry, (tuple, list)) else (entry, entry)
+        if low > high:
+            raise ValueError(f"Empty CAN ID range: 0x{low:X}-0x{high:X}")
+        spans.append((low, high))
+    spans.sort()
+
+    merged = []
+    for low, high in spans:
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def _clip(intervals, low, high):
+    return [(max(a, low), min(b, high)) for a, b in intervals if a <= high and b >= low]
+
+
+def _subtract(intervals, removed):
+    """Parts of intervals not covered by removed (both sorted and merged)"""
+    result = []
+    for low, high in intervals:
+        for r_low, r_high in removed:
+            if r_high < low or r_low > high:
+                continue
+            if r_low > low:
+                result.append((low, r_low - 1))
+            low = r_high + 1
+            if low > high:
+                break
+        if low <= high:
+            result.append((low, high))
+    return result
+
+
+def _prefix_blocks(low, high, id_max):
+    """Cover [low, high] with aligned power-of-two blocks as (base, mask) pairs"""
+    blocks = []
+    while low <= high:
+        size = low & -low if low else id_max + 1
+        while size > high - low + 1:
+            size >>= 1
+        blocks.append((low, id_max & ~(size - 1)))
+        low += size
+    return blocks
+
+
+def parse_id_range(text):
+    """'0x123' -> 0x123, '0x200-0x2FF' -> (0x200, 0x2FF)"""
+    low, sep, high = text.partition('-')
+    if not sep:
+        return int(low, 0)
+    return int(low, 0), int(high, 0)
+
+
+def build_can_filters(allow_ids=None, deny_ids=None):
+    """
+    Translate allow/deny CAN ID lists into python-can can_filters
+    Entries are IDs or inclusive (low, high) ranges; IDs above 0x7FF are
+    29-bit. Without an allow list everything not denied passes. Returns
+    None when no filtering is configured.
+    """
+    if not allow_ids and not deny_ids:
+        return None
+
+    deny = _intervals(deny_ids or [])
+    filters = []
+    for extended, id_min, id_max in ((False, 0, STANDARD_ID_MAX),
+                                     (True, STANDARD_ID_MAX + 1, EXTENDED_ID_MAX)):
+        if allow_ids:
+            allowed = _clip(_intervals(allow_ids), id_min, id_max)
+        else:
+            allowed = [(0 if extended else id_min, id_max)]
+        for low, high in _subtract(allowed, _clip(deny, id_min, id_max)):
+            for base, mask in _prefix_blocks(low, high, id_max):
+                filters.append({"can_id": base, "can_mask": mask, "extended": extended})
+
+    if not filters:
+        raise ValueError("CAN ID filters reject every frame")
+    return filters
+
+
+class FrameCounter:
+    """Count every frame on a channel on a second, unfiltered bus
+
+    Keeps per-ID totals for traffic the acceptance filters hide from the
+    detectors, without inspecting it.
+    """
+
+    def __init__(self, channel, interface='socketcan', bitrate=500000):
+        self.bus = can.interface.Bus(channel=channel, interface=interface,
+                                     bitrate=bitrate)
+        self.counts = Counter()
+        self.total = 0
+        self._running = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ids-counter',
+                                        daemon=True)
+
+    def _run(self):
+        counts, recv = self.counts, self.bus.recv
+        while self._running.is_set():
+            msg = recv(timeout=0.5)
+            if msg is None:
+                continue
+            counts[msg.arbitration_id] += 1
+            self.total += 1
+
+    def start(self):
+        self._running.set()
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.bus.shutdown()
+
+    def stats(self):
+        """Total frames on the bus and the busiest IDs"""
+        return {
+            'total': self.total,
+            'ids': len(self.counts),
+            'top': ", ".join(f"0x{can_id:03X}:{count}"
+                             for can_id, count in self.counts.most_common(5)),
+        }
@@ -4,181 +4,670 @@ Network-Based IDS for CAN Bus
 Monitors traffic, detects anomalies, logs incidents
 """
 
+import argparse
 import can
-import sqlite3
+import os
+import select
 from datetime import datetime
-from collections import defaultdict, deque
+from collections import defaultdict
 import numpy as np
-import json
+import time
 import paho.mqtt.client as mqtt
 
+from alerts import AlertAggregator
+from anomalies import (DLC_MISMATCH, DOS_ATTACK, INVALID_DATA, MASK_SEVERITY, MASK_TYPE,
+                       OUT_OF_RANGE, PATTERN_DEVIATION, TIMING_EARLY, TIMING_LATE,
+                       UNKNOWN_ID, anomaly_names)
+from async_ids import AsyncIDS
+from baseline import load_baseline, save_baseline
+from capture import CaptureRing
+from decoders import FieldSpec
+from detectors import (FrameBatch, IdGroups, InterArrivalModel, PayloadLookup,
+                       PayloadProfile, PayloadStats, RateWindow, SensorLookup,
+                       check_intervals, exceeds_rate)
+from filters import FrameCounter, build_can_filters, parse_id_range
+from metrics import IDSMetrics, start_exporters
+from persistence import PERSIST_MODES, SummaryPolicy
+from pipeline import IDSPipeline
+from replay import iter_capture
+from sharding import ShardedDetector
+from storage import DatabaseWriter
+
 class CANNetworkIDS:
-    def __init__(self, channel='can0', bitrate=500000, mqtt_broker='localhost', mqtt_port=1883):
-        """Initialize the network-based IDS"""
-        self.bus = can.interface.Bus(channel=channel, 
-                                     interface='socketcan',
-                                     bitrate=bitrate)
+    # check_order names -> check methods
+    CHECKS = {
+        'unknown_id': '_check_unknown_id',
+        'dlc': '_check_dlc',
+        'sensor_range': '_check_sensor_range',
+        'frequency': '_check_frequency',
+        'pattern': '_check_pattern',
+        'timing': '_check_timing',
+        'payload': '_check_payload',
+    }
+    
+    def __init__(self, channel='can0', bitrate=500000, mqtt_broker='localhost', mqtt_port=1883,
+                 online_learning=False, db_path='can_ids.db', db_batch_size=500,
+                 db_flush_interval=1.0, db_synchronous='NORMAL', interface='socketcan',
+                 db_writer=None, mqtt_client=None, allow_ids=None, deny_ids=None,
+                 count_unfiltered=False, alerts=None, alert_log='intrusions.log',
+                 db_layout='rows', db_partition_seconds=None, db_retention=None,
+                 db_compact_after=None, persist='all', persist_context=16,
+                 capture_dir=None, capture_pre=5.0, capture_post=5.0):
+        """
+        Initialize the network-based IDS
+        channel=None opens no bus (offline evaluation with run_offline);
+        mqtt_broker=None disables MQTT alerts. db_writer/mqtt_client share
+        another instance's backends (closed by their owner, not here).
+        allow_ids/deny_ids (IDs or (low, high) ranges) become kernel
+        acceptance filters; count_unfiltered still counts every frame.
+        alerts shares another instance's AlertAggregator; alert_log=None
+        writes no intrusions.log. db_layout='packed' stores frames as
+        24-byte records in frame_blocks instead of messages rows.
+        db_partition_seconds rotates the database into one file per period;
+        db_retention/db_compact_after (seconds) delete or strip old ones.
+        persist='summary' stores anomalies with persist_context frames
+        around them and per-second aggregates instead of every frame.
+        capture_dir writes a candump log of the capture_pre seconds before
+        and capture_post seconds after each anomaly into that directory.
+        """
+        self.channel = channel
+        self.bus = None
+        self.counter = None
+        self.can_filters = build_can_filters(allow_ids, deny_ids)
+        if channel is not None:
+            self.bus = can.interface.Bus(channel=channel, 
+                                         interface=interface,
+                                         bitrate=bitrate,
+                                         can_filters=self.can_filters)
+            if count_unfiltered:
+                self.counter = FrameCounter(channel, interface=interface,
+                                            bitrate=bitrate)
+                self.counter.start()
         
         # Initialize MQTT client
-        self.mqtt_client = mqtt.Client()
+        self.mqtt_client = mqtt_client
         self.mqtt_broker = mqtt_broker
         self.mqtt_port = mqtt_port
-        try:
-            self.mqtt_client.connect(mqtt_broker, mqtt_port, 60)
-            self.mqtt_client.loop_start()
-            print(f"Connected to MQTT broker at {mqtt_broker}:{mqtt_port}")
-        except Exception as e:
-            print(f"Warning: Could not connect to MQTT broker: {e}")
+        self._owns_mqtt = mqtt_client is None
+        if mqtt_client is None and mqtt_broker is not None:
+            self.mqtt_client = mqtt.Client()
+            try:
+                self.mqtt_client.connect(mqtt_broker, mqtt_port, 60)
+                self.mqtt_client.loop_start()
+                print(f"Connected to MQTT broker at {mqtt_broker}:{mqtt_port}")
+            except Exception as e:
+                print(f"Warning: Could not connect to MQTT broker: {e}")
+        
+        # Alert dispatch: deduplicated, rate-limited, log file kept open
+        self.alerts = alerts
+        self._owns_alerts = alerts is None
+        if alerts is None and (alert_log is not None or self.mqtt_client is not None):
+            self.alerts = AlertAggregator(log_path=alert_log, mqtt_client=self.mqtt_client)
         
         # Configuration for your sensor network
+        # CAN ID range, value range (physical units), payload field
+        # (FieldSpec defaults to the first byte, unsigned, unscaled)
         self.sensor_ranges = {
-            'temperature': (0x300, 0x399, 0, 120),      # CAN ID range, value range
-            "air_quality": (0x500, 0x599, 0, 700),
-            "gas": (0x600, 0x699, 0, 500),
+            # 1-byte servo frames (servoMotor.ino: 0x301 out, 0x321 button)
+            "barrier_command": (0x300, 0x32F, 0, 1),
+            'temperature': (0x330, 0x399, 0, 120, FieldSpec(width=2, scale=0.01)),
+            "air_quality": (0x500, 0x599, 0, 700, FieldSpec(width=2)),
+            "gas": (0x600, 0x699, 0, 500, FieldSpec(width=2)),
             "occupancy": (0x700, 0x799, 0, 1),
             "barrier_state": (0x400, 0x499, 0, 1),
-            "barrier_command": (0x300, 0x399, 0, 1),
         }
         
         # Baseline statistics (learned during normal operation)
-        self.message_frequency = defaultdict(deque)  # CAN ID -> list of timestamps
-        self.message_patterns = defaultdict(list)     # CAN ID -> payload patterns
+        self.message_frequency = {}                    # CAN ID -> recent timestamps
+        self.payload_stats = defaultdict(PayloadStats) # CAN ID -> per-byte running stats
         self.baseline_dlc = {}                         # CAN ID -> expected DLC
+        self.interarrival = defaultdict(InterArrivalModel)  # CAN ID -> learned period
+        self.payload_profiles = defaultdict(PayloadProfile)  # CAN ID -> byte-level model
+        self.payload_lookup = PayloadLookup(self.payload_profiles)  # Stacked for batches
         
         # Tuning parameters
         self.window_size = 10
         self.frequency_threshold = 100  # msgs per second (too high = DoS)
+        self.rate_window = 1.0          # Seconds covered by the frequency check
+        self.rate_id_limit = 4096       # Non-baseline IDs with a rate window (idle ones evicted first)
         self.anomaly_threshold = 0.8    # Reconstruction error threshold
+        self.pattern_threshold = 50     # Mean abs deviation from baseline pattern (bytes)
+        self.online_learning = online_learning  # Keep updating payload stats in run()
+        self.verbose = True             # Print each anomaly and periodic stats
+        self.timing_k = 4.0             # Jitter multiples tolerated around the period
+        self.timing_tolerance = 0.1     # Extra relative margin on the timing bounds
+        self.timing_min_samples = 10    # Intervals needed before timing is checked
+        self.payload_min_samples = 50   # Frames learned before an ID's payload profile is checked
+        self.payload_entropy_limit = 2.0  # Bytes up to this entropy (bits) are enumerations
+        self.payload_step_margin = 2.0  # Multiple of the largest learned byte step accepted
+        self.payload_bit_tolerance = 2  # Constant bits a frame may flip (Hamming distance)
+        self.check_order = tuple(self.CHECKS)  # Evaluation order of the checks
+        self.short_circuit = False      # Stop at the first triggered check
         
         # Initialize database
-        self._init_database()
+        self._owns_db = db_writer is None
+        if db_writer is not None:
+            self.db = db_writer
+        else:
+            self._init_database(db_path, db_batch_size, db_flush_interval,
+                                db_synchronous, db_layout, db_partition_seconds,
+                                db_retention, db_compact_after)
+        
+        # Persistence policy (None: every frame is stored)
+        if persist not in PERSIST_MODES:
+            raise ValueError(f"Unknown persistence mode: {persist}")
+        self.persistence = None
+        if persist == 'summary':
+            self.persistence = SummaryPolicy(context=persist_context,
+                                             decode=self._decode_value)
+        
+        # Pre/post-trigger capture of this bus around anomalies
+        self.capture = None
+        if capture_dir is not None:
+            self.capture = CaptureRing(channel, directory=capture_dir,
+                                       pre_seconds=capture_pre, post_seconds=capture_post)
         
         # Statistics
         self.message_count = 0
         self.anomaly_count = 0
+        self.evicted_frames = 0  # Lifetime frames of evicted rate windows
+        self.pipeline = None    # Set while run_pipelined()/run_sharded() is active
+        self.metrics = IDSMetrics()    # None disables detector timing
+        self._exporters = []           # Started by serve_metrics()
+        
+        # Wall-clock epoch of the monotonic clock, for frames without a
+        # kernel receive timestamp
+        self._clock_offset = time.time() - time.monotonic()
+    
+    def _compile_sensor_ranges(self):
+        """Build the CAN ID lookup table (run by the sensor_ranges setter)"""
+        self.sensor_lookup = SensorLookup(self.sensor_ranges)
+        for first, second, id_lo, id_hi in self.sensor_lookup.overlaps:
+            print(f"Warning: sensor range '{second}' overlaps '{first}' "
+                  f"on 0x{id_lo:03X}-0x{id_hi:03X}; those IDs resolve to '{first}'")
+    
+    def _frame_time(self, msg):
+        """Authoritative time of a frame: its (kernel) receive timestamp"""
+        if msg.timestamp:
+            return msg.timestamp
+        # Fallback: monotonic clock expressed on the wall-clock epoch
+        return time.monotonic() + self._clock_offset
+    
+    def _new_rate_window(self):
+        """Create a rate tracker sized just above the DoS threshold"""
+        return RateWindow(window=self.rate_window,
+                          capacity=self.frequency_threshold + 1)
+    
+    def _frequency_window(self, can_id, now):
+        """
+        Rate tracker of a CAN ID, created on first sight
+        Baseline IDs keep theirs; windows of other IDs (fuzzed or swept ID
+        spaces) are capped at rate_id_limit by _evict_rate_windows.
+        """
+        rate = self.message_frequency.get(can_id)
+        if rate is None:
+            if len(self.message_frequency) - len(self.baseline_dlc) >= self.rate_id_limit:
+                self._evict_rate_windows(now)
+            rate = self.message_frequency[can_id] = self._new_rate_window()
+        return rate
+    
+    def _evict_rate_windows(self, now):
+        """Drop rate windows of non-baseline IDs, idle ones first"""
+        frequency, baseline = self.message_frequency, self.baseline_dlc
+        seen = [(rate.last, can_id) for can_id, rate in frequency.items()
+                if can_id not in baseline and rate.last is not None]
+        # An idle window counts nothing, so dropping it changes no verdict
+        horizon = now - self._rate_window
+        evict = [can_id for last, can_id in seen if last <= horizon]
+        if len(evict) < len(seen) // 2:
+            # IDs swept faster than the window: keep the most recently seen half
+            seen.sort()
+            evict = [can_id for _, can_id in seen[:len(seen) // 2]]
+        for can_id in evict:
+            self.evicted_frames += frequency.pop(can_id).total
+    
+    @property
+    def frequency_threshold(self):
+        return self._frequency_threshold
+    
+    @frequency_threshold.setter
+    def frequency_threshold(self, value):
+        """Keep every rate window's cap just above the new threshold"""
+        self._frequency_threshold = value
+        for rate in self.message_frequency.values():
+            rate.resize(value + 1)
+    
+    @property
+    def rate_window(self):
+        return self._rate_window
+    
+    @rate_window.setter
+    def rate_window(self, value):
+        self._rate_window = value
+        for rate in self.message_frequency.values():
+            rate.window = value
+    
+    @property
+    def sensor_ranges(self):
+        return self._sensor_ranges
+    
+    @sensor_ranges.setter
+    def sensor_ranges(self, value):
+        """Assign a new mapping: edits made in place are not recompiled"""
+        self._sensor_ranges = value
+        self._compile_sensor_ranges()
+    
+    @property
+    def check_order(self):
+        return self._check_order
+    
+    @check_order.setter
+    def check_order(self, value):
+        """Validate the check names and resolve them into check methods"""
+        value = tuple(value)
+        unknown = [name for name in value if name not in self.CHECKS]
+        if unknown:
+            raise ValueError(f"Unknown checks in check_order: {', '.join(unknown)}")
+        self._check_order = value
+        self._compile_checks()
     
-    def _init_database(self):
-        """Create SQLite database for logging"""
-        self.conn = sqlite3.connect('can_ids.db')
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY,
-                timestamp REAL,
-                can_id INTEGER,
-                dlc INTEGER,
-                data BLOB,
-                is_anomaly BOOLEAN
-            )
-        ''')
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS anomalies (
-                id INTEGER PRIMARY KEY,
-                timestamp REAL,
-                can_id INTEGER,
-                anomaly_type TEXT,
-                severity TEXT,
-                details TEXT
-            )
-        ''')
-        self.conn.commit()
-    
-    def learn_baseline(self, duration_seconds=60):
-        """Learn normal traffic patterns during initialization"""
+    @property
+    def short_circuit(self):
+        return self._short_circuit
+    
+    @short_circuit.setter
+    def short_circuit(self, value):
+        self._short_circuit = bool(value)
+    
+    # The payload_* tunables are baked into the profiles' lookup tables
+    @property
+    def payload_min_samples(self):
+        return self._payload_min_samples
+    
+    @payload_min_samples.setter
+    def payload_min_samples(self, value):
+        self._payload_min_samples = value
+        self._compile_profiles(self.payload_profiles)
+    
+    @property
+    def payload_entropy_limit(self):
+        return self._payload_entropy_limit
+    
+    @payload_entropy_limit.setter
+    def payload_entropy_limit(self, value):
+        self._payload_entropy_limit = value
+        self._compile_profiles(self.payload_profiles)
+    
+    @property
+    def payload_step_margin(self):
+        return self._payload_step_margin
+    
+    @payload_step_margin.setter
+    def payload_step_margin(self, value):
+        self._payload_step_margin = value
+        self._compile_profiles(self.payload_profiles)
+    
+    @property
+    def payload_bit_tolerance(self):
+        return self._payload_bit_tolerance
+    
+    @payload_bit_tolerance.setter
+    def payload_bit_tolerance(self, value):
+        self._payload_bit_tolerance = value
+        self._compile_profiles(self.payload_profiles)
+    
+    def _decode_value(self, can_id, data):
+        """Physical value of a sensor frame (None if no sensor range covers it)"""
+        sensor = self.sensor_lookup.lookup(can_id)
+        if sensor is None or not data:
+            return None
+        return sensor.decoder.decode(data)
+    
+    def _init_database(self, path, batch_size, flush_interval, synchronous, layout='rows',
+                       partition_seconds=None, retention=None, compact_after=None):
+        """Create SQLite database for logging (written behind the hot path)"""
+        if path is None:
+            # Detection-only instance (e.g. a shard worker): nothing is logged
+            self.db = None
+            return
+        self.db = DatabaseWriter(path,
+                                 batch_size=batch_size,
+                                 flush_interval=flush_interval,
+                                 synchronous=synchronous,
+                                 layout=layout,
+                                 partition_seconds=partition_seconds,
+                                 retention=retention,
+                                 compact_after=compact_after)
+    
+    def learn_baseline(self, duration_seconds=60, only_missing=False):
+        """
+        Learn normal traffic patterns during initialization
+        With only_missing=True, IDs already in the baseline (e.g. loaded
+        from disk) keep their stored state and only new IDs are learned.
+        """
         print(f"Learning baseline for {duration_seconds} seconds...")
-        start_time = datetime.now().timestamp()
+        known = set(self.baseline_dlc) if only_missing else set()
+        learned = set()
+        deadline = time.monotonic() + duration_seconds
         
-        while datetime.now().timestamp() - start_time < duration_seconds:
+        while time.monotonic() < deadline:
             msg = self.bus.recv(timeout=1)
             if msg is None:
                 continue
             
-            # Record message frequency
-            self.message_frequency[msg.arbitration_id].append(
-                datetime.now().timestamp()
-            )
-            
-            # Record DLC
-            self.baseline_dlc[msg.arbitration_id] = msg.dlc
-            
-            # Record payload pattern
-            self.message_patterns[msg.arbitration_id].append(msg.data)
-            
             self.message_count += 1
+            if msg.arbitration_id in known:
+                continue
+            learned.add(msg.arbitration_id)
+            self._learn_message(msg, self._frame_time(msg))
         
-        print(f"Learned {len(self.message_frequency)} unique CAN IDs")
+        self._finalize_baseline(learned)
+        print(f"Learned {len(learned)} unique CAN IDs")
         self._print_baseline_stats()
     
+    def _learn_message(self, msg, timestamp):
+        """Fold one benign frame into the baseline"""
+        # Record message frequency and inter-arrival times
+        self._frequency_window(msg.arbitration_id, timestamp).append(timestamp)
+        self.interarrival[msg.arbitration_id].learn(timestamp)
+        
+        # Record DLC
+        self.baseline_dlc[msg.arbitration_id] = msg.dlc
+        
+        # Record payload pattern and byte-level structure
+        self.payload_stats[msg.arbitration_id].update(msg.data)
+        self.payload_profiles[msg.arbitration_id].learn(msg.data)
+    
+    def save_baseline(self, path):
+        """Store the learned baseline so the next start can skip the warm-up"""
+        save_baseline(path, self.baseline_dlc, self.payload_stats, self.interarrival,
+                      self.payload_profiles)
+        print(f"Baseline for {len(self.baseline_dlc)} CAN IDs saved to {path}")
+    
+    def load_baseline(self, path):
+        """Replace the in-memory baseline with one stored by save_baseline"""
+        baseline_dlc, payload_stats, interarrival, payload_profiles = load_baseline(path)
+        self.baseline_dlc = baseline_dlc
+        self.payload_stats = defaultdict(PayloadStats, payload_stats)
+        self.interarrival = defaultdict(InterArrivalModel, interarrival)
+        self.payload_profiles = defaultdict(PayloadProfile, payload_profiles)
+        self._compile_profiles(payload_profiles)
+        print(f"Loaded baseline for {len(baseline_dlc)} CAN IDs from {path}")
+    
+    def _finalize_baseline(self, can_ids):
+        """Turn learned samples into timing bounds and payload lookup tables"""
+        for can_id in can_ids:
+            self.interarrival[can_id].finalize(k=self.timing_k,
+                           tolerance=self.timing_tolerance,
+                           min_samples=self.timing_min_samples)
+        self._compile_profiles(can_ids)
+    
+    def _compile_profiles(self, can_ids):
+        """Build payload lookup tables (rerun by the payload_* setters)"""
+        for can_id in list(can_ids):
+            profile = self.payload_profiles.get(can_id)
+            if profile is not None:
+                profile.finalize(min_samples=self._payload_min_samples,
+                                 entropy_limit=self._payload_entropy_limit,
+                                 step_margin=self._payload_step_margin,
+                                 bit_tolerance=self._payload_bit_tolerance)
+        self.payload_lookup = PayloadLookup(self.payload_profiles)
+    
     def _print_baseline_stats(self):
         """Display learned baseline statistics"""
         print("\n=== BASELINE STATISTICS ===")
-        for can_id, timestamps in sorted(self.message_frequency.items()):
-            if len(timestamps) > 1:
-                intervals = np.diff(timestamps)
-                freq = len(timestamps)
-                print(f"CAN ID 0x{can_id:03X}: {freq} msgs, "
-                      f"avg interval: {np.mean(intervals)*1000:.1f}ms")
-    
-    def _detect_anomalies(self, msg):
+        for can_id, rate in sorted(self.message_frequency.items()):
+            interval = rate.mean_interval()
+            if interval is not None:
+                print(f"CAN ID 0x{can_id:03X}: {rate.total} msgs, "
+                      f"avg interval: {interval*1000:.1f}ms")
+            timing = self.interarrival.get(can_id)
+            if timing is not None and timing.lower is not None:
+                print(f"    jitter: {timing.jitter*1000:.1f}ms, "
+                      f"p1/p99: {timing.p_low*1000:.1f}/{timing.p_high*1000:.1f}ms, "
+                      f"accepted: {timing.lower*1000:.1f}-{timing.upper*1000:.1f}ms")
+            profile = self.payload_profiles.get(can_id)
+            if profile is not None and profile.rules:
+                entropy = profile.entropy[:self.baseline_dlc.get(can_id, 0)]
+                print(f"    payload: {len(profile.rules)} byte rules, entropy "
+                      f"{'/'.join(f'{bits:.1f}' for bits in entropy)} bits")
+    
+    def _compile_checks(self):
+        """Resolve check_order into check methods (run by the check_order setter)"""
+        if self._check_order == tuple(self.CHECKS):
+            self._checks = None    # Default order: fused path in _detect_default
+        else:
+            self._checks = tuple(getattr(self, self.CHECKS[name]) for name in self._check_order)
+    
+    def _detect_anomalies(self, msg, now=None):
         """
         Multi-layered anomaly detection
-        Returns: (is_anomaly, anomaly_type, severity)
+        `now` is the frame time (defaults to _frame_time(msg))
+        Returns the bitmask of triggered checks (0 = clean, see anomalies.py)
         """
-        anomalies = []
+        if now is None:
+            now = self._frame_time(msg)
+        can_id = msg.arbitration_id
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.countdown -= 1
+            if metrics.countdown <= 0:
+                metrics.countdown = metrics.sample_every
+                return self._detect_timed(msg, can_id, now, metrics)
+        if self._checks is None:
+            return self._detect_default(msg, can_id, now)
         
-        # Check 1: Unknown CAN ID
-        if msg.arbitration_id not in self.baseline_dlc:
-            anomalies.append(("unknown_id", "WARNING"))
+        mask = 0
+        for check in self._checks:
+            mask |= check(msg, can_id, now)
+            if mask and self._short_circuit:
+                self._skip_timing(can_id, now)
+                break
+        return mask
+    
+    def _detect_timed(self, msg, can_id, now, metrics):
+        """_detect_anomalies with every check timed (a sampled frame)"""
+        clock = time.perf_counter_ns
+        started = clock()
+        mask = 0
+        for name in self._check_order:
+            check_started = clock()
+            mask |= getattr(self, self.CHECKS[name])(msg, can_id, now)
+            metrics.observe_check(name, (clock() - check_started) * 1e-9)
+            if mask and self._short_circuit:
+                self._skip_timing(can_id, now)
+                break
+        metrics.detect_seconds.observe((clock() - started) * 1e-9)
+        return mask
+    
+    def _skip_timing(self, can_id, now):
+        """Skipped checks must still advance the per-ID period tracker"""
+        timing = self.interarrival.get(can_id)
+        if timing is not None:
+            timing.last = now
+    
+    def _detect_default(self, msg, can_id, now):
+        """The _check_* methods inlined in the default order (no call overhead)"""
+        short_circuit = self._short_circuit
         
-        # Check 2: DLC mismatch
-        if msg.arbitration_id in self.baseline_dlc:
-            if msg.dlc != self.baseline_dlc[msg.arbitration_id]:
-                anomalies.append(("dlc_mismatch", "CRITICAL"))
+        # Check 1 and 2: Unknown CAN ID, DLC mismatch
+        expected = self.baseline_dlc.get(can_id)
+        if expected is None:
+            mask = UNKNOWN_ID
+        elif msg.dlc != expected:
+            mask = DLC_MISMATCH
+        else:
+            mask = 0
+        if mask and short_circuit:
+            self._skip_timing(can_id, now)
+            return mask
         
         # Check 3: Sensor range validation
-        can_id = msg.arbitration_id
-        for sensor_type, (id_min, id_max, val_min, val_max) in self.sensor_ranges.items():
-            if id_min <= can_id <= id_max:
-                # This is a sensor message
-                if msg.dlc >= 1:
-                    if msg.data is None or len(msg.data) == 0:
-                        anomalies.append(("invalid_data", "HIGH"))
-                        break
-                    value = msg.data[0]
-                    if not (val_min <= value <= val_max):
-                        anomalies.append(("out_of_range", "HIGH"))
-                break
+        sensor = self.sensor_lookup.lookup(can_id)
+        if sensor is not None and msg.dlc >= 1:
+            value = sensor.decoder.decode_raw(msg.data) if msg.data else None
+            if value is None:
+                mask |= INVALID_DATA
+            elif not (sensor.raw_min <= value <= sensor.raw_max):
+                mask |= OUT_OF_RANGE
+            if mask and short_circuit:
+                self._skip_timing(can_id, now)
+                return mask
         
         # Check 4: Frequency analysis (DoS detection)
-        if can_id in self.message_frequency:
-            recent_msgs = self.message_frequency[can_id]
-            # Keep only last second of messages
-            now = datetime.now().timestamp()
-            recent_msgs = [t for t in recent_msgs 
-                         if now - t < 1.0]
-            
-            if len(recent_msgs) > self.frequency_threshold:
-                anomalies.append(("dos_attack", "CRITICAL"))
+        rate = self.message_frequency.get(can_id)
+        if rate is not None and rate.count(now) > self.frequency_threshold:
+            mask |= DOS_ATTACK
+            if short_circuit:
+                self._skip_timing(can_id, now)
+                return mask
         
         # Check 5: Pattern deviation (fuzzing detection)
-        if can_id in self.message_patterns:
-            baseline_patterns = self.message_patterns[can_id]
-            if baseline_patterns:
-                baseline_data = np.array(
-                    [list(p) for p in baseline_patterns]
-                )
-                curr_data = np.array(list(msg.data))
-                
-                # Calculate deviation from mean pattern
-                mean_pattern = np.mean(baseline_data, axis=0)
-                deviation = np.abs(curr_data - mean_pattern).mean()
-                
-                if deviation > 50:  # Threshold in bytes
-                    anomalies.append(("pattern_deviation", "MEDIUM"))
+        stats = self.payload_stats.get(can_id)
+        if stats is not None and stats.samples:
+            if stats.deviation(msg.data) > self.pattern_threshold:
+                mask |= PATTERN_DEVIATION
+                if short_circuit:
+                    self._skip_timing(can_id, now)
+                    return mask
+        
+        # Check 6: Inter-arrival timing (injection between periodic frames)
+        timing = self.interarrival.get(can_id)
+        if timing is not None:
+            early_or_late = timing.check(now)
+            if early_or_late < 0:
+                mask |= TIMING_EARLY
+            elif early_or_late > 0:
+                mask |= TIMING_LATE
+            if mask and short_circuit:
+                return mask
         
-        if anomalies:
-            return True, anomalies[0][0], anomalies[0][1]
-        return False, None, None
+        # Check 7: Byte values and transitions (fuzzing of single bytes)
+        profile = self.payload_profiles.get(can_id)
+        if profile is not None:
+            mask |= profile.check(msg.data)
+        return mask
+    
+    # Check 1: Unknown CAN ID
+    def _check_unknown_id(self, msg, can_id, now):
+        return 0 if can_id in self.baseline_dlc else UNKNOWN_ID
+    
+    # Check 2: DLC mismatch
+    def _check_dlc(self, msg, can_id, now):
+        expected = self.baseline_dlc.get(can_id)
+        return DLC_MISMATCH if expected is not None and msg.dlc != expected else 0
+    
+    # Check 3: Sensor range validation
+    def _check_sensor_range(self, msg, can_id, now):
+        sensor = self.sensor_lookup.lookup(can_id)
+        if sensor is None or msg.dlc < 1:
+            return 0
+        # This is a sensor message
+        value = sensor.decoder.decode_raw(msg.data) if msg.data else None
+        if value is None:
+            return INVALID_DATA
+        if not (sensor.raw_min <= value <= sensor.raw_max):
+            return OUT_OF_RANGE
+        return 0
+    
+    # Check 4: Frequency analysis (DoS detection)
+    def _check_frequency(self, msg, can_id, now):
+        rate = self.message_frequency.get(can_id)
+        # Expired timestamps are evicted as the window slides
+        if rate is not None and rate.count(now) > self.frequency_threshold:
+            return DOS_ATTACK
+        return 0
+    
+    # Check 5: Pattern deviation (fuzzing detection)
+    def _check_pattern(self, msg, can_id, now):
+        stats = self.payload_stats.get(can_id)
+        if stats is not None and stats.samples:
+            # Calculate deviation from mean pattern
+            if stats.deviation(msg.data) > self.pattern_threshold:
+                return PATTERN_DEVIATION
+        return 0
+    
+    # Check 6: Inter-arrival timing (injection between periodic frames)
+    def _check_timing(self, msg, can_id, now):
+        timing = self.interarrival.get(can_id)
+        if timing is None:
+            return 0
+        early_or_late = timing.check(now)
+        if early_or_late < 0:
+            return TIMING_EARLY
+        if early_or_late > 0:
+            return TIMING_LATE
+        return 0
+    
+    # Check 7: Byte values and transitions (fuzzing of single bytes)
+    def _check_payload(self, msg, can_id, now):
+        profile = self.payload_profiles.get(can_id)
+        return profile.check(msg.data) if profile is not None else 0
+    
+    def _detect_batch(self, batch):
+        """
+        Vectorised multi-layered anomaly detection over a FrameBatch
+        Records each frame in its rate window, in arrival order.
+        Returns one anomaly bitmask per frame, matching _detect_anomalies.
+        """
+        n = len(batch)
+        groups = IdGroups(batch.ids)
+        ids, inverse = groups.ids.tolist(), groups.inverse
+        
+        # Per-ID baseline lookups are done once per distinct ID in the batch
+        expected_dlc = np.array([self.baseline_dlc.get(can_id, -1) for can_id in ids],
+                                dtype=np.int16)[inverse]
+        means = np.zeros((len(ids), 8))
+        learned = np.zeros((len(ids), 8), dtype=bool)
+        for u, can_id in enumerate(ids):
+            stats = self.payload_stats.get(can_id)
+            if stats is not None and stats.samples:
+                means[u] = stats.mean
+                learned[u] = np.array(stats.count) > 0
+        
+        # Check 1 and 2: Unknown CAN ID, DLC mismatch
+        unknown = expected_dlc < 0
+        dlc_mismatch = ~unknown & (batch.dlcs != expected_dlc)
+        
+        # Check 3: Sensor range validation
+        invalid, out_of_range = self.sensor_lookup.validate_batch(
+            batch.ids, batch.dlcs, batch.payloads, batch.lengths)
+        
+        # Check 4, 6 and 7: Frequency, inter-arrival timing and byte
+        # transitions, per ID over its frames in arrival order
+        start = batch.timestamps[0]
+        dos = exceeds_rate([self._frequency_window(can_id, start) for can_id in ids],
+                           groups, batch.timestamps, self.frequency_threshold)
+        timing = check_intervals([self.interarrival.get(can_id) for can_id in ids],
+                                 groups, batch.timestamps)
+        payload = self.payload_lookup.check_batch(ids, groups, batch.payloads, batch.lengths)
+        
+        # Check 5: Pattern deviation over the byte positions the baseline covers
+        positions = learned[inverse] & (np.arange(8) < batch.lengths[:, None])
+        diff = np.abs(batch.payloads - means[inverse]) * positions
+        npos = positions.sum(axis=1)
+        deviation = np.divide(diff.sum(axis=1), npos,
+                              out=np.zeros(n), where=npos > 0)
+        pattern = deviation > self.pattern_threshold
+        
+        # Combine in check_order; with short_circuit only the first
+        # triggered check of each frame counts, as in _detect_anomalies
+        bits = {
+            'unknown_id': unknown * UNKNOWN_ID,
+            'dlc': dlc_mismatch * DLC_MISMATCH,
+            'sensor_range': invalid * INVALID_DATA | out_of_range * OUT_OF_RANGE,
+            'frequency': dos * DOS_ATTACK,
+            'pattern': pattern * PATTERN_DEVIATION,
+            'timing': (timing < 0) * TIMING_EARLY | (timing > 0) * TIMING_LATE,
+            'payload': payload,
+        }
+        masks = np.zeros(n, dtype=np.uint16)
+        for name in self._check_order:
+            found = bits[name].astype(np.uint16)
+            if self._short_circuit:
+                found[masks != 0] = 0
+            masks |= found
+        return masks.tolist()
     
     def run(self):
         """Main IDS loop"""
@@ -191,94 +680,268 @@ class CANNetworkIDS:
                 if msg is None:
                     continue
                 
-                # Update statistics
-                self.message_frequency[msg.arbitration_id].append(
-                    datetime.now().timestamp()
-                )
-                self.message_count += 1
-                
-                # Detect anomalies
-                is_anomaly, anom_type, severity = self._detect_anomalies(msg)
+                self._process_message(msg)
+        
+        except KeyboardInterrupt:
+            print("\nIDS Stopped.")
+        finally:
+            self._cleanup()
+    
+    def _process_message(self, msg, timestamp=None):
+        """Detect, log and respond to one received frame"""
+        if timestamp is None:
+            timestamp = self._frame_time(msg)
+        self._observe(msg, timestamp)
+        
+        # Detect anomalies
+        mask = self._detect_anomalies(msg, timestamp)
+        
+        self._respond(msg, timestamp, mask)
+        return mask
+    
+    def _observe(self, msg, timestamp):
+        """Count one received frame and record it in its rate window"""
+        self._frequency_window(msg.arbitration_id, timestamp).append(timestamp)
+        self.message_count += 1
+    
+    def run_offline(self, path, learn_seconds=0):
+        """
+        Evaluate a recorded capture as fast as the CPU allows
+        The recorded timestamps are the clock. The first learn_seconds of
+        the capture (by recorded time) train the baseline before detection.
+        Returns a summary dict; resources are released afterwards.
+        """
+        print(f"Offline evaluation of {path}")
+        self.verbose = False
+        if self.db is not None:
+            self.db.block_when_full = True    # Never drop rows in offline runs
+        counts = defaultdict(int)
+        learned = set()
+        learn_until = None
+        frames = 0
+        started = time.perf_counter()
+        
+        try:
+            for msg in iter_capture(path):
+                frames += 1
+                timestamp = msg.timestamp    # Recorded time, even if it starts at 0
+                if learn_until is None:
+                    learn_until = timestamp + learn_seconds
+                if timestamp < learn_until:
+                    learned.add(msg.arbitration_id)
+                    self._learn_message(msg, timestamp)
+                    continue
+                if learned:
+                    self._finalize_baseline(learned)
+                    learned = set()
                 
-                # Log message
-                self._log_message(msg, is_anomaly)
+                mask = self._process_message(msg, timestamp)
+                if mask:
+                    for anom_type in anomaly_names(mask):
+                        counts[anom_type] += 1
+        finally:
+            self._cleanup()
+        
+        elapsed = time.perf_counter() - started
+        summary = {
+            'frames': frames,
+            'inspected': self.message_count,
+            'anomalies': self.anomaly_count,
+            'by_type': dict(counts),
+            'elapsed_s': elapsed,
+            'frames_per_s': frames / elapsed if elapsed > 0 else 0.0,
+        }
+        print(f"Processed {frames} frames in {elapsed:.2f}s "
+              f"({summary['frames_per_s']:.0f} frames/s)")
+        print(f"Inspected {self.message_count}, anomalies: {self.anomaly_count}")
+        for anom_type, count in sorted(counts.items()):
+            print(f"   {anom_type}: {count}")
+        return summary
+    
+    def run_batched(self, max_batch=256, max_latency=0.005):
+        """
+        Main IDS loop, micro-batched
+        Drains up to max_batch frames (waiting at most max_latency seconds
+        after the first one) and runs the detectors over the whole batch.
+        """
+        print(f"Network-Based IDS Started (batches of up to {max_batch} frames). "
+              f"Press Ctrl+C to stop.")
+        
+        try:
+            while True:
+                messages, timestamps = self._drain_bus(max_batch, max_latency)
+                if not messages:
+                    continue
                 
-                if is_anomaly:
-                    self._handle_anomaly(msg, anom_type, severity)
+                batch = FrameBatch(messages, timestamps)
+                started = time.perf_counter()
+                masks = self._detect_batch(batch)
+                if self.metrics is not None:
+                    self.metrics.batch_seconds.observe(time.perf_counter() - started)
                 
-                # Periodic stats
-                if self.message_count % 1000 == 0:
-                    self._print_stats()
+                for msg, timestamp, mask in zip(messages, timestamps, masks):
+                    self.message_count += 1
+                    self._respond(msg, timestamp, mask)
         
         except KeyboardInterrupt:
             print("\nIDS Stopped.")
         finally:
             self._cleanup()
     
-    def _log_message(self, msg, is_anomaly):
-        """Log message to database"""
-        self.cursor.execute('''
-            INSERT INTO messages 
-            (timestamp, can_id, dlc, data, is_anomaly)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (datetime.now().timestamp(), msg.arbitration_id, 
-              msg.dlc, msg.data.hex(), is_anomaly))
+    def run_pipelined(self, rx_capacity=65536, sink_capacity=65536):
+        """
+        Main IDS loop, staged
+        Reception, detection, persistence and alerting run on separate
+        threads joined by bounded queues, so slow sinks cannot stall recv.
+        """
+        print("Network-Based IDS Started (pipelined). Press Ctrl+C to stop.")
+        self.pipeline = IDSPipeline(self, rx_capacity=rx_capacity,
+                                    sink_capacity=sink_capacity)
+        try:
+            self.pipeline.run_forever()
+        except KeyboardInterrupt:
+            print("\nIDS Stopped.")
+        finally:
+            self._cleanup()
+    
+    def run_sharded(self, workers=None, capacity=65536, partition='hash'):
+        """
+        Main IDS loop, sharded across processes
+        Frames are partitioned by arbitration ID ('hash' or 'range') across
+        worker processes that own the per-ID state of their shard; verdicts
+        are merged back in arrival order before logging and alerting.
+        """
+        sharded = ShardedDetector(self, workers=workers, capacity=capacity,
+                                  partition=partition)
+        print(f"Network-Based IDS Started ({sharded.workers} detection processes). "
+              f"Press Ctrl+C to stop.")
+        self.pipeline = sharded
+        sharded.start()
+        try:
+            while True:
+                msg = self.bus.recv(timeout=0.01)
+                if msg is not None:
+                    sharded.dispatch(msg, self._frame_time(msg))
+                sharded.collect()
+        except KeyboardInterrupt:
+            print("\nIDS Stopped.")
+        finally:
+            sharded.stop()
+            self._cleanup()
+    
+    def run_async(self, rx_capacity=65536, sink_capacity=65536):
+        """
+        Main IDS loop on asyncio
+        Frames arrive through can.Notifier; detection, persistence and
+        alerting are coroutines, so other async services can share the loop.
+        """
+        print("Network-Based IDS Started (asyncio). Press Ctrl+C to stop.")
+        runner = AsyncIDS([self], rx_capacity=rx_capacity, sink_capacity=sink_capacity)
+        try:
+            runner.run()
+            print("\nIDS Stopped.")
+        finally:
+            self._cleanup()
+    
+    def _drain_bus(self, max_batch, max_latency):
+        """Collect frames already queued on the bus into one batch"""
+        messages, timestamps = [], []
+        msg = self.bus.recv(timeout=1)
+        if msg is None:
+            return messages, timestamps
+        
+        deadline = time.monotonic() + max_latency
+        while msg is not None:
+            messages.append(msg)
+            timestamps.append(self._frame_time(msg))
+            remaining = deadline - time.monotonic()
+            if len(messages) >= max_batch or remaining <= 0:
+                break
+            msg = self.bus.recv(timeout=remaining)
+        return messages, timestamps
+    
+    def _respond(self, msg, timestamp, mask):
+        """Log, alert and learn from one classified frame"""
+        # Log message
+        self._log_message(msg, timestamp, mask != 0)
+        
+        if mask:
+            self._handle_anomaly(msg, timestamp, mask)
+        self._after_detect(msg, mask)
+    
+    def _after_detect(self, msg, mask):
+        """
+        Online learning and periodic stats for one classified frame
+        Runners that hand logging and alerting to other stages call this
+        directly instead of _respond.
+        """
+        if not mask and self.online_learning:
+            # Track slow drift of benign payloads (baseline IDs only)
+            stats = self.payload_stats.get(msg.arbitration_id)
+            if stats is not None:
+                stats.update(msg.data)
         
-        if self.message_count % 100 == 0:
-            self.conn.commit()
+        # Periodic stats
+        if self.verbose and self.message_count % 1000 == 0:
+            self._print_stats()
+    
+    def _log_message(self, msg, timestamp, is_anomaly):
+        """Queue message for the database writer (and the capture ring)"""
+        rows = self._stored_rows(msg, timestamp, is_anomaly)
+        if rows:
+            self.db.log_messages(rows)
+    
+    def _stored_rows(self, msg, timestamp, is_anomaly):
+        """Record a frame in the capture ring; returns the messages rows to store"""
+        if self.capture is not None:
+            self.capture.record(msg, timestamp, is_anomaly)
+        if self.db is None:
+            return ()
+        row = self._message_row(msg, timestamp, is_anomaly)
+        if self.persistence is None:
+            return (row,)
+        return self._summarise(row)
+    
+    def _summarise(self, row):
+        """Apply the summary policy to a messages row; returns the rows to store"""
+        rows, summaries = self.persistence.observe(row)
+        if summaries:
+            self.db.log_summaries(summaries)
+        return rows
+    
+    def _message_row(self, msg, timestamp, is_anomaly):
+        """messages table row for one frame"""
+        return (timestamp, msg.arbitration_id, msg.dlc, msg.data,
+                is_anomaly, self.channel)
     
-    def _handle_anomaly(self, msg, anom_type, severity):
-        """Handle detected anomaly"""
+    def _handle_anomaly(self, msg, timestamp, mask):
+        """Handle detected anomaly (mask: every triggered check)"""
         self.anomaly_count += 1
+        if self.metrics is not None:
+            # Only baseline IDs get their own series (fuzzing cannot add labels)
+            can_id = msg.arbitration_id if msg.arbitration_id in self.baseline_dlc else None
+            self.metrics.anomalies[can_id, mask] += 1
+        # Alerts and the anomaly_type column name the most severe finding
+        anom_type, severity = MASK_TYPE[mask], MASK_SEVERITY[mask]
         
-        print(f"\nANOMALY DETECTED [#{self.anomaly_count}]")
-        print(f"   Severity: {severity}")
-        print(f"   Type: {anom_type}")
-        print(f"   CAN ID: 0x{msg.arbitration_id:03X}")
-        print(f"   Data: {msg.data.hex()}")
-        print(f"   Timestamp: {datetime.now().isoformat()}")
-        
-        # Log to database
-        self.cursor.execute('''
-            INSERT INTO anomalies 
-            (timestamp, can_id, anomaly_type, severity, details)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (datetime.now().timestamp(), msg.arbitration_id,
-              anom_type, severity, msg.data.hex()))
-        self.conn.commit()
-        
-        # Action based on severity
-        if severity == "CRITICAL":
-            self._trigger_alert(msg, anom_type)
-    
-    def _trigger_alert(self, msg, anom_type):
-        """Trigger protective actions"""
-        # Option 1: Log and notify
-        with open('intrusions.log', 'a') as f:
-            f.write(f"{datetime.now().isoformat()}: {anom_type} on 0x{msg.arbitration_id:03X}\n")
-        
-        # Option 2: Send to MQTT
-        alert_payload = {
-            "timestamp": datetime.now().isoformat(),
-            "anomaly_type": anom_type,
-            "can_id": f"0x{msg.arbitration_id:03X}",
-            "data": msg.data.hex(),
-            "dlc": msg.dlc
-        }
-        try:
-            self.mqtt_client.publish(
-                "ids/alerts",
-                json.dumps(alert_payload),
-                qos=1
-            )
-            print(f"   ACTION: Alert sent to MQTT topic 'ids/alerts'")
-        except Exception as e:
-            print(f"   ERROR: Could not send MQTT alert: {e}")
+        # Repeats of an ongoing incident are folded into one summary alert;
+        # CRITICAL incidents go to intrusions.log and MQTT. Without an
+        # aggregator nothing is folded, so every anomaly is printed
+        first = self.alerts is None or self.alerts.submit(
+            msg, timestamp, anom_type, severity, self.channel)
         
-        # Option 3: Send alert via email/SMS
-        # self._send_alert(msg, anom_type)
+        if self.verbose and first:
+            print(f"\nANOMALY DETECTED [#{self.anomaly_count}]")
+            print(f"   Severity: {severity}")
+            print(f"   Type: {', '.join(anomaly_names(mask))}")
+            print(f"   CAN ID: 0x{msg.arbitration_id:03X}")
+            print(f"   Data: {msg.data.hex()}")
+            print(f"   Timestamp: {datetime.fromtimestamp(timestamp).isoformat()}")
         
-        print(f"   ACTION: Alert triggered for {anom_type}")
+        # Log to database (every anomaly, coalesced or not)
+        if self.db is not None:
+            self.db.log_anomaly((timestamp, msg.arbitration_id, anom_type, severity,
+                                 msg.data.hex(), self.channel, mask))
     
     def _print_stats(self):
         """Print IDS statistics"""
@@ -288,20 +951,295 @@ class CANNetworkIDS:
         print(f"Messages processed: {self.message_count}")
         print(f"Anomalies detected: {self.anomaly_count}")
         print(f"Detection rate: {detection_rate:.2f}%")
+        if self.alerts is not None:
+            print("Alerts: " + ", ".join(f"{key}={value}"
+                                         for key, value in self.alerts.stats().items()))
+        if self.counter is not None:
+            counted = self.counter.stats()
+            print(f"Frames on bus: {counted['total']} "
+                  f"({counted['total'] - self.message_count} not inspected), "
+                  f"busiest IDs: {counted['top']}")
+        if self.pipeline is not None:
+            for name, stats in self.pipeline.stats().items():
+                print(f"Stage {name}: " +
+                      ", ".join(f"{key}={value}" for key, value in stats.items()))
+    
+    def serve_metrics(self, port=9108, host='127.0.0.1', snapshot_interval=None):
+        """
+        Expose metrics on http://host:port/metrics (port=None: no server)
+        snapshot_interval (seconds) also copies them into the metrics table.
+        """
+        self._exporters = start_exporters([self], port, host, snapshot_interval)
     
     def _cleanup(self):
         """Cleanup resources"""
-        self.mqtt_client.loop_stop()
-        self.mqtt_client.disconnect()
-        self.conn.close()
-        self.bus.shutdown()
+        for exporter in self._exporters:
+            exporter.stop()    # Final snapshot before the database closes
+        if self.capture is not None:
+            self.capture.close()    # Writes out a capture still open
+        if self.persistence is not None and self.db is not None:
+            self.db.log_summaries(self.persistence.flush())
+        if self.alerts is not None and self._owns_alerts:
+            self.alerts.close()    # Publishes summaries of open incidents
+        if self.mqtt_client is not None and self._owns_mqtt:
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.disconnect()
+        if self.db is not None and self._owns_db:
+            self.db.close()    # Flushes rows still buffered
+        if self.counter is not None:
+            self.counter.stop()
+        if self.bus is not None:
+            self.bus.shutdown()
+
+
+class MultiChannelIDS:
+    """
+    Monitor several CAN channels from one IDS process
+    Each channel has its own CANNetworkIDS (baseline, detector state,
+    counters); the SQLite writer and MQTT client of the first channel are
+    shared by all, and one select() loop reads every bus.
+    """
+    
+    def __init__(self, channels, drain_limit=256, **kwargs):
+        if not channels:
+            raise ValueError("At least one channel is required")
+        first = CANNetworkIDS(channel=channels[0], **kwargs)
+        self.detectors = {channels[0]: first}
+        shared = dict(kwargs, db_writer=first.db, mqtt_client=first.mqtt_client,
+                      alerts=first.alerts)
+        for channel in channels[1:]:
+            self.detectors[channel] = CANNetworkIDS(channel=channel, **shared)
+        
+        self.drain_limit = drain_limit    # Frames read per ready bus per pass
+        self._by_bus = {ids.bus: ids for ids in self.detectors.values()}
+        try:
+            self._selectable = all(bus.fileno() >= 0 for bus in self._by_bus)
+        except NotImplementedError:
+            # e.g. python-can's virtual interface: poll instead
+            self._selectable = False
+    
+    def _receive(self, timeout):
+        """(ids, msg) pairs for every frame waiting on any channel"""
+        if self._selectable:
+            readable, _, _ = select.select(list(self._by_bus), [], [], timeout)
+        else:
+            readable = list(self._by_bus)
+        
+        received = []
+        for bus in readable:
+            ids = self._by_bus[bus]
+            for _ in range(self.drain_limit):
+                msg = bus.recv(timeout=0)
+                if msg is None:
+                    break
+                received.append((ids, msg))
+        if not received and not self._selectable:
+            time.sleep(min(timeout, 0.001))
+        return received
+    
+    def learn_baseline(self, duration_seconds=60, only_missing=False, channels=None):
+        """
+        Learn a separate baseline for every channel
+        With `channels`, only those channels learn; frames of the others are
+        counted but leave their (e.g. loaded) baselines untouched.
+        """
+        channels = list(self.detectors) if channels is None else list(channels)
+        print(f"Learning baselines for {duration_seconds} seconds on "
+              f"{', '.join(channels)}...")
+        known = {channel: set(self.detectors[channel].baseline_dlc) if only_missing else set()
+                 for channel in channels}
+        learned = {channel: set() for channel in channels}
+        deadline = time.monotonic() + duration_seconds
+        
+        while time.monotonic() < deadline:
+            for ids, msg in self._receive(timeout=0.1):
+                ids.message_count += 1
+                if ids.channel not in learned or msg.arbitration_id in known[ids.channel]:
+                    continue
+                learned[ids.channel].add(msg.arbitration_id)
+                ids._learn_message(msg, ids._frame_time(msg))
+        
+        for channel in channels:
+            ids = self.detectors[channel]
+            ids._finalize_baseline(learned[channel])
+            print(f"\n[{channel}] Learned {len(learned[channel])} unique CAN IDs")
+            ids._print_baseline_stats()
+    
+    @staticmethod
+    def baseline_path(path, channel):
+        """Per-channel baseline file derived from a base path"""
+        root, ext = os.path.splitext(path)
+        return f"{root}_{channel}{ext or '.npz'}"
+    
+    def save_baseline(self, path, channels=None):
+        """Store per-channel baselines (all channels, or only `channels`)"""
+        for channel in self.detectors if channels is None else channels:
+            self.detectors[channel].save_baseline(self.baseline_path(path, channel))
+    
+    def load_baseline(self, path):
+        """Load stored per-channel baselines; returns channels that had none"""
+        missing = []
+        for channel, ids in self.detectors.items():
+            channel_path = self.baseline_path(path, channel)
+            if os.path.exists(channel_path):
+                ids.load_baseline(channel_path)
+            else:
+                missing.append(channel)
+        return missing
+    
+    def run(self):
+        """Main IDS loop over all channels"""
+        print(f"Network-Based IDS Started on {', '.join(self.detectors)}. "
+              f"Press Ctrl+C to stop.")
+        try:
+            while True:
+                for ids, msg in self._receive(timeout=1):
+                    ids._process_message(msg)
+        except KeyboardInterrupt:
+            print("\nIDS Stopped.")
+        finally:
+            self._cleanup()
+    
+    def run_async(self, rx_capacity=65536, sink_capacity=65536):
+        """Serve every channel from one asyncio event loop"""
+        print(f"Network-Based IDS Started (asyncio) on {', '.join(self.detectors)}. "
+              f"Press Ctrl+C to stop.")
+        runner = AsyncIDS(self.detectors.values(), rx_capacity=rx_capacity,
+                          sink_capacity=sink_capacity)
+        try:
+            runner.run()
+            print("\nIDS Stopped.")
+        finally:
+            self._cleanup()
+    
+    def _print_stats(self):
+        for channel, ids in self.detectors.items():
+            print(f"\n[{channel}]", end="")
+            ids._print_stats()
+    
+    def serve_metrics(self, port=9108, host='127.0.0.1', snapshot_interval=None):
+        """One /metrics endpoint (and snapshotter) covering every channel"""
+        first = next(iter(self.detectors.values()))
+        first._exporters = start_exporters(self.detectors.values(), port, host,
+                                           snapshot_interval)
+    
+    def _cleanup(self):
+        """Release every bus, then the shared backends (owned by the first)"""
+        for ids in reversed(list(self.detectors.values())):
+            ids._cleanup()
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Network-Based IDS for CAN Bus",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--channel", nargs="+", default=["can0"],
+                        help="SocketCAN channel(s) (e.g., can0, vcan0); several channels share one IDS")
+    parser.add_argument("--bitrate", type=int, default=500000, help="Bitrate in bps")
+    parser.add_argument("--baseline", default="can_ids_baseline.npz",
+                        help="Baseline file: loaded if it exists, otherwise written after learning")
+    parser.add_argument("--learn-seconds", type=float, default=60,
+                        help="Warm-up duration when no stored baseline is available")
+    parser.add_argument("--learn-missing", action="store_true",
+                        help="With a stored baseline, also learn IDs missing from it and save the result")
+    parser.add_argument("--replay", default=None,
+                        help="Evaluate a recorded capture (candump .log, .asc, .blf or AttackLogger .csv) "
+                             "offline instead of monitoring a bus")
+    parser.add_argument("--db", default="can_ids.db", help="SQLite database for messages/anomalies")
+    parser.add_argument("--db-layout", choices=("rows", "packed"), default="rows",
+                        help="Store frames as messages rows, or as packed 24-byte records in frame_blocks")
+    parser.add_argument("--db-rotate", type=float, default=None, metavar="SECONDS",
+                        help="Write one database file per period of frame time, e.g. 3600 (<db>-<UTC start>.db)")
+    parser.add_argument("--db-retention", type=float, default=None, metavar="SECONDS",
+                        help="With --db-rotate, delete partitions older than this")
+    parser.add_argument("--db-compact-after", type=float, default=None, metavar="SECONDS",
+                        help="With --db-rotate, drop stored frames (keeping anomalies) from partitions older than this")
+    parser.add_argument("--allow", nargs="+", type=parse_id_range, default=None, metavar="ID[-ID]",
+                        help="Only inspect these CAN IDs/ranges (kernel acceptance filter), e.g. 0x200-0x2FF 0x501")
+    parser.add_argument("--deny", nargs="+", type=parse_id_range, default=None, metavar="ID[-ID]",
+                        help="Never inspect these CAN IDs/ranges (kernel acceptance filter)")
+    parser.add_argument("--count-all", action="store_true",
+                        help="With --allow/--deny, still count every frame on an unfiltered socket")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (0 = off)")
+    parser.add_argument("--metrics-snapshot", type=float, default=0, metavar="SECONDS",
+                        help="Also copy all metrics into the database's metrics table this often (0 = off)")
+    parser.add_argument("--persist", choices=("all", "summary"), default="all",
+                        help="Store every frame, or anomalies in context plus per-second aggregates")
+    parser.add_argument("--persist-context", type=int, default=16, metavar="N",
+                        help="With --persist summary, frames kept before and after each anomaly")
+    parser.add_argument("--capture-dir", default=None, metavar="DIR",
+                        help="Write a candump log of the traffic around each anomaly into DIR")
+    parser.add_argument("--capture-pre", type=float, default=5.0, metavar="SECONDS",
+                        help="With --capture-dir, seconds of traffic kept before an anomaly")
+    parser.add_argument("--capture-post", type=float, default=5.0, metavar="SECONDS",
+                        help="With --capture-dir, seconds of traffic captured after an anomaly")
+    return parser
+
+
+def database_options(args):
+    """CANNetworkIDS storage and capture keyword arguments from the command line"""
+    if (args.db_retention or args.db_compact_after) and not args.db_rotate:
+        raise SystemExit("--db-retention/--db-compact-after require --db-rotate")
+    return dict(db_layout=args.db_layout, db_partition_seconds=args.db_rotate,
+                db_retention=args.db_retention, db_compact_after=args.db_compact_after,
+                persist=args.persist, persist_context=args.persist_context,
+                capture_dir=args.capture_dir, capture_pre=args.capture_pre,
+                capture_post=args.capture_post)
+
 
 if __name__ == '__main__':
+    args = build_parser().parse_args()
+    
+    if args.replay:
+        # Offline: no bus, no MQTT, no intrusions.log (replayed incidents are
+        # not live alerts); learn from the head of the capture unless a
+        # stored baseline is available
+        ids = CANNetworkIDS(channel=None, mqtt_broker=None, db_path=args.db,
+                            alert_log=None, **database_options(args))
+        learn_seconds = args.learn_seconds
+        if os.path.exists(args.baseline):
+            ids.load_baseline(args.baseline)
+            learn_seconds = 0
+        ids.run_offline(args.replay, learn_seconds=learn_seconds)
+        raise SystemExit(0)
+    
+    if len(args.channel) > 1:
+        # One process, one shared database and MQTT client, a baseline per channel
+        ids = MultiChannelIDS(args.channel, bitrate=args.bitrate, db_path=args.db,
+                              allow_ids=args.allow, deny_ids=args.deny,
+                              count_unfiltered=args.count_all, **database_options(args))
+        if args.metrics_port or args.metrics_snapshot:
+            ids.serve_metrics(port=args.metrics_port or None,
+                              snapshot_interval=args.metrics_snapshot)
+        missing = ids.load_baseline(args.baseline)
+        # Channels without a stored baseline learn from scratch; with
+        # --learn-missing every channel adds the IDs its baseline lacks
+        learning = list(ids.detectors) if args.learn_missing else missing
+        if learning:
+            ids.learn_baseline(duration_seconds=args.learn_seconds,
+                               only_missing=True, channels=learning)
+            ids.save_baseline(args.baseline, channels=learning)
+        ids.run()
+        raise SystemExit(0)
+    
     # Create IDS instance
-    ids = CANNetworkIDS(channel='can0', bitrate=500000)
+    ids = CANNetworkIDS(channel=args.channel[0], bitrate=args.bitrate, db_path=args.db,
+                        allow_ids=args.allow, deny_ids=args.deny,
+                        count_unfiltered=args.count_all, **database_options(args))
+    if args.metrics_port or args.metrics_snapshot:
+        ids.serve_metrics(port=args.metrics_port or None,
+                          snapshot_interval=args.metrics_snapshot)
     
-    # Learn normal traffic patterns (60 seconds of normal operation)
-    ids.learn_baseline(duration_seconds=60)
+    # Reuse a stored baseline, or learn normal traffic patterns
+    if os.path.exists(args.baseline):
+        ids.load_baseline(args.baseline)
+        if args.learn_missing:
+            ids.learn_baseline(duration_seconds=args.learn_seconds, only_missing=True)
+            ids.save_baseline(args.baseline)
+    else:
+        ids.learn_baseline(duration_seconds=args.learn_seconds)
+        ids.save_baseline(args.baseline)
     
     # Start monitoring
     ids.run()
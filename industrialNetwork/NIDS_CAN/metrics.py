@@ -0,0 +1,303 @@
+"""
+Metrics for the CAN Network IDS
+Low-overhead histograms and counters, rendered in the Prometheus text format
+and served on a local HTTP /metrics endpoint
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from anomalies import anomaly_names
+
+# Seconds; 1 us to ~1 s in roughly x2.5 steps
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                   1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two additions"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)    # Last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Prometheus samples: cumulative buckets, sum and count"""
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f"{name}_bucket", dict(labels, le=le), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class IDSMetrics:
+    """
+    Instrumentation owned by one CANNetworkIDS
+    Check timings come from one frame in every `sample_every`; counters the
+    IDS already keeps (rate windows, statistics) are read at scrape time.
+    """
+
+    def __init__(self, sample_every=64):
+        self.sample_every = sample_every
+        self.check_seconds = {}             # Check name -> Histogram
+        self.detect_seconds = Histogram()
+        self.batch_seconds = Histogram()    # run_batched: one sample per batch
+        self.countdown = sample_every       # Frames until the next timed one
+        self.anomalies = Counter()          # (CAN ID or None if unknown, mask) -> count
+
+    def observe_check(self, name, seconds):
+        histogram = self.check_seconds.get(name)
+        if histogram is None:
+            histogram = self.check_seconds[name] = Histogram()
+        histogram.observe(seconds)
+
+
+def _id_label(can_id):
+    return 'unknown' if can_id is None else f"0x{can_id:03X}"
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def collect(ids, skip=()):
+    """
+    (name, type, help, [(sample name, labels, value)]) families for one IDS
+    `skip` names backends ('db', 'alerts') already reported for another channel.
+    """
+    channel = {'channel': ids.channel} if ids.channel else {}
+    metrics = ids.metrics
+    families = []
+
+    families.append(('can_ids_frames_total', 'counter', 'Frames inspected',
+                     [('can_ids_frames_total', channel, ids.message_count)]))
+    families.append(('can_ids_anomalies_total', 'counter', 'Frames flagged as anomalous',
+                     [('can_ids_anomalies_total', channel, ids.anomaly_count)]))
+
+    # Copies: the detection thread may add IDs while a scrape iterates. IDs
+    # outside the baseline share one 'unknown' series, so a fuzzer sweeping
+    # the ID space cannot create a series per ID
+    baseline = dict(ids.baseline_dlc)
+    frames = Counter()
+    for can_id, rate in list(ids.message_frequency.items()):
+        frames[can_id if can_id in baseline else None] += rate.total
+    if ids.evicted_frames:
+        frames[None] += ids.evicted_frames    # Windows dropped by _evict_rate_windows
+    families.append(('can_ids_id_frames_total', 'counter',
+                     'Frames seen per CAN ID (including baseline learning)',
+                     [('can_ids_id_frames_total', dict(channel, can_id=_id_label(can_id)), count)
+                      for can_id, count in sorted(frames.items(), key=lambda item: (item[0] is None, item))]))
+
+    if metrics is not None:
+        by_type = Counter()
+        for (can_id, mask), count in list(metrics.anomalies.items()):
+            for anom_type in anomaly_names(mask):
+                by_type[can_id, anom_type] += count
+        families.append(('can_ids_id_anomalies_total', 'counter',
+                         'Anomaly findings per CAN ID and type',
+                         [('can_ids_id_anomalies_total',
+                           dict(channel, can_id=_id_label(can_id), type=anom_type), count)
+                          for (can_id, anom_type), count in sorted(
+                              by_type.items(), key=lambda item: (item[0][0] is None, item))]))
+
+        samples = []
+        for name, histogram in sorted(metrics.check_seconds.items()):
+            samples.extend(histogram.samples('can_ids_check_seconds', dict(channel, check=name)))
+        families.append(('can_ids_check_seconds', 'histogram',
+                         f"Per-check latency (1 in {metrics.sample_every} frames)", samples))
+        families.append(('can_ids_detect_seconds', 'histogram',
+                         f"Detection latency of all checks (1 in {metrics.sample_every} frames)",
+                         list(metrics.detect_seconds.samples('can_ids_detect_seconds', channel))))
+        families.append(('can_ids_detect_batch_seconds', 'histogram',
+                         'Vectorised detection latency of one batch',
+                         list(metrics.batch_seconds.samples('can_ids_detect_batch_seconds',
+                                                            channel))))
+
+    if ids.pipeline is not None:
+        samples = []
+        for stage, stats in ids.pipeline.stats().items():
+            for key, value in stats.items():
+                if isinstance(value, (bool, int, float)):
+                    samples.append(('can_ids_stage', dict(channel, stage=stage, stat=key),
+                                    int(value) if isinstance(value, bool) else value))
+        families.append(('can_ids_stage', 'gauge',
+                         'Runner stage counters and queue depths', samples))
+
+    # Backends may be shared by several channels: labelled by database, not channel
+    if ids.db is not None and 'db' not in skip:
+        db = ids.db
+        database = {'db': db.path}
+        families.append(('can_ids_db_pending', 'gauge', 'Rows buffered for the database',
+                         [('can_ids_db_pending', database, db.pending())]))
+        families.append(('can_ids_db_rows_total', 'counter', 'Database rows by outcome',
+                         [('can_ids_db_rows_total', dict(database, outcome='written'), db.rows_written),
+                          ('can_ids_db_rows_total', dict(database, outcome='dropped'), db.dropped)]))
+        families.append(('can_ids_db_flush_seconds', 'histogram',
+                         'Duration of one database batch transaction',
+                         list(db.flush_seconds.samples('can_ids_db_flush_seconds', database))))
+        if db.partition_seconds:
+            families.append(('can_ids_db_partitions_total', 'counter',
+                             'Partitions deleted or compacted by the retention policy',
+                             [('can_ids_db_partitions_total', dict(database, action='removed'),
+                               db.partitions_removed),
+                              ('can_ids_db_partitions_total', dict(database, action='compacted'),
+                               db.partitions_compacted)]))
+
+    if ids.persistence is not None:
+        families.append(('can_ids_persist_frames_total', 'counter',
+                         'Frames stored raw or folded into per-second aggregates',
+                         [('can_ids_persist_frames_total', dict(channel, outcome='kept'),
+                           ids.persistence.kept),
+                          ('can_ids_persist_frames_total', dict(channel, outcome='summarised'),
+                           ids.persistence.summarised)]))
+
+    if ids.capture is not None:
+        families.append(('can_ids_captures_total', 'counter',
+                         'Anomaly captures started (pre/post-trigger ring)',
+                         [('can_ids_captures_total', channel, ids.capture.captures)]))
+        families.append(('can_ids_capture_frames_total', 'counter',
+                         'Frames written to anomaly captures',
+                         [('can_ids_capture_frames_total', channel, ids.capture.frames_captured)]))
+
+    if ids.alerts is not None and 'alerts' not in skip:
+        alerts = ids.alerts
+        families.append(('can_ids_alerts', 'gauge', 'Alert aggregator counters',
+                         [('can_ids_alerts', {'stat': key}, value)
+                          for key, value in alerts.stats().items()]))
+        families.append(('can_ids_mqtt_publish_seconds', 'histogram',
+                         'MQTT alert publish to broker acknowledgement',
+                         list(alerts.publish_seconds.samples('can_ids_mqtt_publish_seconds', {}))))
+
+    if ids.counter is not None:
+        families.append(('can_ids_bus_frames_total', 'counter',
+                         'Frames on the bus, before acceptance filters',
+                         [('can_ids_bus_frames_total', channel, ids.counter.total)]))
+    return families
+
+
+def collect_all(detectors):
+    """collect() over several IDS, merging families and shared backends"""
+    merged = {}
+    seen = set()
+    for ids in detectors:
+        # A database or aggregator shared between channels is reported once
+        shared = {name for name in ('db', 'alerts')
+                  if getattr(ids, name) is not None and id(getattr(ids, name)) in seen}
+        seen.update(id(getattr(ids, name)) for name in ('db', 'alerts'))
+        for name, kind, help_text, samples in collect(ids, skip=shared):
+            merged.setdefault(name, (kind, help_text, []))[2].extend(samples)
+    return [(name, kind, help_text, samples)
+            for name, (kind, help_text, samples) in merged.items()]
+
+
+def render(detectors):
+    """Prometheus text exposition for one or more CANNetworkIDS"""
+    lines = []
+    for name, kind, help_text, samples in collect_all(detectors):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples:
+            lines.append(f"{sample}{_label_text(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serve render(detectors) on http://host:port/metrics from a daemon thread"""
+
+    def __init__(self, detectors, host='127.0.0.1', port=9108):
+        self.detectors = list(detectors)
+        detectors = self.detectors
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render(detectors).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # No access log on stdout
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='ids-metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsSnapshotter:
+    """Periodically copy every metric sample into the database's metrics table"""
+
+    def __init__(self, detectors, db, interval=60.0):
+        self.detectors = list(detectors)
+        self.db = db
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ids-metrics-snapshot',
+                                        daemon=True)
+
+    def snapshot(self):
+        now = time.time()
+        self.db.log_metrics([(now, sample, _label_text(labels), float(value))
+                             for _, _, _, samples in collect_all(self.detectors)
+                             for sample, labels, value in samples])
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.snapshot()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.snapshot()
+
+
+def start_exporters(detectors, port=9108, host='127.0.0.1', snapshot_interval=None):
+    """
+    Start the /metrics server (port=None: none) and, with a database and
+    snapshot_interval, the SQLite snapshotter. Returns the started services.
+    """
+    detectors = list(detectors)
+    services = []
+    if port is not None:
+        server = MetricsServer(detectors, host=host, port=port)
+        server.start()
+        print(f"Metrics at http://{host}:{server.port}/metrics")
+        services.append(server)
+    db = detectors[0].db
+    if snapshot_interval and db is not None:
+        snapshotter = MetricsSnapshotter(detectors, db, interval=snapshot_interval)
+        snapshotter.start()
+        services.append(snapshotter)
+    return services
@@ -0,0 +1,109 @@
+"""
+Persistence policies for the CAN Network IDS
+Sample-or-summarise: raw rows only around anomalies, per-second aggregates
+for the benign rest of the traffic
+"""
+
+import json
+from collections import deque
+
+PERSIST_MODES = ('all', 'summary')
+
+
+class SecondSummary:
+    """Benign traffic of one CAN ID within one second"""
+
+    __slots__ = ('frames', 'value_min', 'value_max', 'value_sum', 'values', 'dlcs')
+
+    def __init__(self):
+        self.frames = 0
+        self.value_min = None
+        self.value_max = None
+        self.value_sum = 0.0
+        self.values = 0           # Frames whose value could be decoded
+        self.dlcs = {}            # DLC -> frames
+
+    def add(self, dlc, value):
+        self.frames += 1
+        self.dlcs[dlc] = self.dlcs.get(dlc, 0) + 1
+        if value is None:
+            return
+        if self.values == 0 or value < self.value_min:
+            self.value_min = value
+        if self.values == 0 or value > self.value_max:
+            self.value_max = value
+        self.value_sum += value
+        self.values += 1
+
+
+class SummaryPolicy:
+    """
+    Keep anomalies in context, summarise everything else
+    Every anomalous frame is stored raw together with up to `context`
+    frames before and after it on the same bus. Every benign frame (context
+    or not) is also counted in per-ID, per-second aggregates: frames,
+    min/max/mean of the decoded value and a DLC histogram.
+    """
+
+    def __init__(self, context=16, decode=None, lateness=1):
+        self.context = context
+        self.decode = decode        # (can_id, data) -> physical value or None
+        self.lateness = lateness    # Seconds a second stays open for late frames
+        self._recent = deque(maxlen=context)    # Benign rows not stored (yet)
+        self._post = 0                          # Rows still to keep after an anomaly
+        self._open = {}                         # (second, can_id, channel) -> SecondSummary
+        self._second = None
+
+        # Statistics
+        self.kept = 0
+        self.summarised = 0
+
+    def observe(self, row):
+        """
+        Apply the policy to one messages row
+        Returns (rows to store raw, finished message_seconds rows).
+        """
+        timestamp, can_id, dlc, data, is_anomaly, channel = row
+        keep = []
+        if is_anomaly:
+            keep.extend(self._recent)
+            self._recent.clear()
+            keep.append(row)
+            self._post = self.context
+        else:
+            key = (int(timestamp), can_id, channel)
+            summary = self._open.get(key)
+            if summary is None:
+                summary = self._open[key] = SecondSummary()
+            summary.add(dlc, self.decode(can_id, data) if self.decode is not None else None)
+            self.summarised += 1
+            if self._post:
+                self._post -= 1
+                keep.append(row)
+            elif self.context:
+                self._recent.append(row)
+        self.kept += len(keep)
+
+        second = int(timestamp)
+        if second == self._second:
+            return keep, ()
+        self._second = second
+        return keep, self._close(second - self.lateness)
+
+    def _close(self, before):
+        """message_seconds rows for every second older than `before`"""
+        finished = [key for key in self._open if key[0] < before]
+        return [self._row(key, self._open.pop(key)) for key in finished]
+
+    def flush(self):
+        """Rows for every open second (on shutdown)"""
+        rows = [self._row(key, summary) for key, summary in self._open.items()]
+        self._open.clear()
+        return rows
+
+    @staticmethod
+    def _row(key, summary):
+        second, can_id, channel = key
+        mean = summary.value_sum / summary.values if summary.values else None
+        return (second, can_id, channel, summary.frames, summary.value_min,
+                summary.value_max, mean, json.dumps(summary.dlcs, separators=(',', ':')))
@@ -0,0 +1,168 @@
+"""
+Staged receive/detect/persist/alert pipeline for the CAN Network IDS
+Each stage runs on its own thread so slow sinks never stall bus.recv
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class FrameRing:
+    """Bounded single-producer/single-consumer FIFO that drops when full
+
+    Relies on deque.append/popleft being atomic, so the hot path takes no
+    lock; the event only wakes a consumer that found the ring empty.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = deque()
+        self._ready = threading.Event()
+
+        # Statistics
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item):
+        """Enqueue without blocking; returns False if the item was dropped"""
+        depth = len(self._items)
+        if depth >= self.capacity:
+            self.dropped += 1
+            return False
+        self._items.append(item)
+        self.enqueued += 1
+        if depth + 1 > self.high_water:
+            self.high_water = depth + 1
+        self._ready.set()
+        return True
+
+    def get(self, timeout):
+        """Dequeue one item, or None if nothing arrived within timeout"""
+        try:
+            return self._items.popleft()
+        except IndexError:
+            pass
+        self._ready.clear()
+        if not self._items:
+            self._ready.wait(timeout)
+        try:
+            return self._items.popleft()
+        except IndexError:
+            return None
+
+    def __len__(self):
+        return len(self._items)
+
+
+class PipelineStage:
+    """One worker thread consuming a FrameRing"""
+
+    def __init__(self, name, capacity, handler):
+        self.name = name
+        self.queue = FrameRing(capacity)
+        self.handler = handler
+        self.processed = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"ids-{name}",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        # Keep draining after stop so nothing already accepted is lost
+        while not (self._stop.is_set() and len(self.queue) == 0):
+            item = self.queue.get(timeout=0.1)
+            if item is None:
+                continue
+            try:
+                self.handler(*item)
+            except Exception as e:
+                self.errors += 1
+                print(f"Warning: {self.name} stage failed: {e}")
+            self.processed += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def stats(self):
+        return {
+            'depth': len(self.queue),
+            'high_water': self.queue.high_water,
+            'enqueued': self.queue.enqueued,
+            'dropped': self.queue.dropped,
+            'processed': self.processed,
+            'errors': self.errors,
+        }
+
+
+class IDSPipeline:
+    """Receive -> detect -> (persist, alert) pipeline around a CANNetworkIDS
+
+    The receive stage only timestamps frames and enqueues them; detection,
+    persistence and alerting each drain their own bounded queue.
+    """
+
+    def __init__(self, ids, rx_capacity=65536, sink_capacity=65536):
+        self.ids = ids
+        self.detect = PipelineStage('detect', rx_capacity, self._detect)
+        self.persist = PipelineStage('persist', sink_capacity, ids._log_message)
+        self.alert = PipelineStage('alert', sink_capacity, ids._handle_anomaly)
+        self.stages = (self.detect, self.persist, self.alert)
+        self.received = 0
+        self._running = threading.Event()
+        self._receiver = threading.Thread(target=self._receive, name='ids-receive',
+                                          daemon=True)
+
+    def _receive(self):
+        """Receive stage: timestamp and enqueue, nothing else"""
+        bus, ring = self.ids.bus, self.detect.queue
+        while self._running.is_set():
+            msg = bus.recv(timeout=0.1)
+            if msg is None:
+                continue
+            self.received += 1
+            ring.put((msg, self.ids._frame_time(msg)))
+
+    def _detect(self, msg, timestamp):
+        """Detection stage: classify and fan out to the sinks"""
+        ids = self.ids
+        ids._observe(msg, timestamp)
+
+        mask = ids._detect_anomalies(msg, timestamp)
+
+        self.persist.queue.put((msg, timestamp, mask != 0))
+        if mask:
+            self.alert.queue.put((msg, timestamp, mask))
+        ids._after_detect(msg, mask)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        self._running.set()
+        self._receiver.start()
+
+    def stop(self):
+        """Stop receiving, then drain every stage in pipeline order"""
+        self._running.clear()
+        self._receiver.join()
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        """Per-stage queue depth, drop and throughput counters"""
+        stats = {stage.name: stage.stats() for stage in self.stages}
+        stats['receive'] = {'received': self.received}
+        return stats
+
+    def run_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        finally:
+            self.stop()
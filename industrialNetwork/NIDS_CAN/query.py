@@ -0,0 +1,174 @@
+"""
+Query layer for the CAN Network IDS database
+Reads a single can_ids.db or fans out over its time partitions; listings are
+keyset-paged and counts come from the per-minute anomaly_minutes aggregate
+"""
+
+import os
+import sqlite3
+from collections import Counter
+
+import numpy as np
+
+from storage import FRAME_DTYPE, list_partitions, read_frames
+
+ANOMALY_COLUMNS = 'timestamp, can_id, anomaly_type, severity, details, channel, anomaly_mask'
+GROUP_COLUMNS = ('anomaly_type', 'can_id', 'channel')
+
+
+class PartitionSet:
+    """
+    Read-only view of an IDS database
+    `path` is what the IDS was given (--db): if partition files of it exist
+    they are queried, otherwise the file itself.
+    """
+
+    def __init__(self, path='can_ids.db'):
+        self.path = path
+
+    def files(self, start=None, end=None):
+        """Database files that may hold rows with timestamps in [start, end]"""
+        partitions = list_partitions(self.path)
+        if not partitions:
+            return [self.path] if os.path.exists(self.path) else []
+        selected = []
+        for index, (first, path) in enumerate(partitions):
+            # A partition ends where the next one starts
+            following = partitions[index + 1][0] if index + 1 < len(partitions) else None
+            if end is not None and first > end:
+                break
+            if start is not None and following is not None and following <= start:
+                continue
+            selected.append(path)
+        return selected
+
+    def execute(self, sql, params=(), start=None, end=None):
+        """Run `sql` on every partition overlapping [start, end]; yields rows, oldest partition first"""
+        for path in self.files(start, end):
+            conn = sqlite3.connect(path)
+            try:
+                yield from conn.execute(sql, params)
+            finally:
+                conn.close()
+
+    def anomalies(self, start=None, end=None, can_id=None, anomaly_type=None, channel=None):
+        """anomalies rows (timestamp, can_id, type, severity, details, channel, mask), oldest first"""
+        where, params = _anomaly_filter(start, end, can_id, anomaly_type, channel)
+        sql = f'SELECT {ANOMALY_COLUMNS} FROM anomalies' + _where(where) + ' ORDER BY timestamp'
+        return list(self.execute(sql, params, start, end))
+
+    def anomaly_page(self, start=None, end=None, can_id=None, anomaly_type=None, channel=None,
+                     limit=100, cursor=None):
+        """
+        One page of anomalies rows, newest first, and the cursor of the next page
+        Pass the returned cursor back to continue (None: no more rows). Each
+        page is an index range scan starting at the cursor, so deep pages
+        cost the same as the first.
+        """
+        where, params = _anomaly_filter(start, end, can_id, anomaly_type, channel)
+        files = self.files(start, end if cursor is None else cursor[0])
+        rows, last = [], None
+        for path in reversed(files):
+            conditions, values = list(where), list(params)
+            if cursor is not None and path == cursor[2]:
+                conditions.append('(timestamp < ? OR (timestamp = ? AND id < ?))')
+                values += [cursor[0], cursor[0], cursor[1]]
+            elif cursor is not None:
+                conditions.append('timestamp < ?')    # Partitions never share a timestamp
+                values.append(cursor[0])
+            sql = (f'SELECT id, {ANOMALY_COLUMNS} FROM anomalies' + _where(conditions) +
+                   ' ORDER BY timestamp DESC, id DESC LIMIT ?')
+            conn = sqlite3.connect(path)
+            try:
+                found = conn.execute(sql, values + [limit - len(rows)]).fetchall()
+            finally:
+                conn.close()
+            if found:
+                rows += [row[1:] for row in found]
+                last = (found[-1][1], found[-1][0], path)
+            if len(rows) >= limit:
+                return rows, last
+        return rows, None
+
+    def anomaly_counts(self, start=None, end=None, by=('anomaly_type',), per_minute=True,
+                       can_id=None, anomaly_type=None, channel=None):
+        """
+        Anomaly counts from the anomaly_minutes aggregate, grouped by `by`
+        (any of anomaly_type, can_id, channel). Returns (minute, *group, count)
+        rows by minute, or (*group, count) totals with per_minute=False.
+        Minutes overlapping start/end are counted whole.
+        """
+        unknown = [column for column in by if column not in GROUP_COLUMNS]
+        if unknown:
+            raise ValueError(f"Cannot group anomalies by: {', '.join(unknown)}")
+        where, params = [], []
+        if start is not None:
+            where.append('minute >= ?')
+            params.append(int(start // 60) * 60)
+        if end is not None:
+            where.append('minute <= ?')
+            params.append(end)
+        for column, value in (('can_id', can_id), ('anomaly_type', anomaly_type),
+                              ('channel', channel)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+        keys = (['minute'] if per_minute else []) + list(by)
+        select = ', '.join(keys + ['sum(count)']) if keys else 'sum(count)'
+        sql = f'SELECT {select} FROM anomaly_minutes' + _where(where)
+        if keys:
+            sql += ' GROUP BY ' + ', '.join(keys)
+
+        # A group can span two partitions (when partitions are not whole minutes)
+        totals = Counter()
+        for row in self.execute(sql, params, start, end):
+            if row[-1] is not None:
+                totals[row[:-1]] += row[-1]
+        return [key + (count,) for key, count in sorted(totals.items())]
+
+    def messages(self, start=None, end=None, can_id=None, channel=None):
+        """messages rows (timestamp, can_id, dlc, data, is_anomaly, channel), oldest first"""
+        where, params = _time_filter(start, end)
+        for column, value in (('can_id', can_id), ('channel', channel)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+        sql = ('SELECT timestamp, can_id, dlc, data, is_anomaly, channel '
+               'FROM messages' + _where(where) + ' ORDER BY timestamp')
+        return list(self.execute(sql, params, start, end))
+
+    def frames(self, start=None, end=None, channel=None):
+        """Frames of the packed layout as one FRAME_DTYPE array"""
+        parts = []
+        for path in self.files(start, end):
+            conn = sqlite3.connect(path)
+            try:
+                parts.append(read_frames(conn, start, end, channel))
+            finally:
+                conn.close()
+        return np.concatenate(parts) if parts else np.empty(0, dtype=FRAME_DTYPE)
+
+
+def _anomaly_filter(start, end, can_id, anomaly_type, channel):
+    where, params = _time_filter(start, end)
+    for column, value in (('can_id', can_id), ('anomaly_type', anomaly_type),
+                          ('channel', channel)):
+        if value is not None:
+            where.append(f'{column} = ?')
+            params.append(value)
+    return where, params
+
+
+def _time_filter(start, end):
+    where, params = [], []
+    if start is not None:
+        where.append('timestamp >= ?')
+        params.append(start)
+    if end is not None:
+        where.append('timestamp <= ?')
+        params.append(end)
+    return where, params
+
+
+def _where(conditions):
+    return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
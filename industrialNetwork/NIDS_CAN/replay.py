@@ -0,0 +1,58 @@
+"""
+Recorded CAN captures as frame sources for offline IDS evaluation
+Supports candump logs, python-can formats (ASC, BLF, ...) and AttackLogger CSV
+"""
+
+import csv
+import os
+
+import can
+
+# Extensions python-can's LogReader dispatches on (besides .csv, see below)
+_LOGREADER_SUFFIXES = ('.asc', '.blf', '.log', '.trc', '.mf4')
+
+
+def _iter_attack_csv(path):
+    """Frames from an AttackLogger CSV (attacks/CANbus/can_attacks.py)"""
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                data = bytes.fromhex(row['data_hex']) if row.get('data_hex') else b''
+                can_id = int(row['id'], 0)
+                yield can.Message(
+                    timestamp=float(row['timestamp']),
+                    arbitration_id=can_id,
+                    is_extended_id=row.get('is_extended') in ('True', 'true', '1')
+                                   or can_id > 0x7FF,
+                    dlc=int(row['dlc']) if row.get('dlc') else len(data),
+                    data=data,
+                )
+            except (KeyError, ValueError):
+                continue
+
+
+def _is_attack_csv(path):
+    with open(path, newline='') as f:
+        header = next(csv.reader(f), [])
+    return 'data_hex' in header
+
+
+def iter_capture(path):
+    """Yield can.Message objects, with their recorded timestamps, from a capture
+
+    `.csv` files written by AttackLogger are parsed directly, other `.csv`
+    files and ASC/BLF/TRC/MF4/candump `.log` files go through python-can's
+    LogReader; any other extension is read as candump -l text.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    suffix = os.path.splitext(path)[1].lower()
+
+    if suffix == '.csv' and _is_attack_csv(path):
+        yield from _iter_attack_csv(path)
+    elif suffix == '.csv' or suffix in _LOGREADER_SUFFIXES:
+        with can.LogReader(path) as reader:
+            yield from reader
+    else:
+        with can.CanutilsLogReader(path) as reader:
+            yield from reader
@@ -0,0 +1,301 @@
+"""
+Multi-process sharded detection for the CAN Network IDS
+Frames are partitioned by arbitration ID across worker processes, each owning
+the per-ID detector state of its shard; a merger restores arrival order
+"""
+
+import contextlib
+import io
+import multiprocessing as mp
+import os
+import platform
+import struct
+import tempfile
+import time
+from multiprocessing import shared_memory
+
+import can
+
+from baseline import save_baseline
+
+# Tunables copied from the parent IDS into every worker's detector
+SHARED_SETTINGS = ('sensor_ranges', 'frequency_threshold', 'rate_window',
+                   'pattern_threshold', 'online_learning', 'timing_k',
+                   'timing_tolerance', 'timing_min_samples', 'payload_min_samples',
+                   'payload_entropy_limit', 'payload_step_margin', 'payload_bit_tolerance',
+                   'check_order', 'short_circuit', 'rate_id_limit')
+
+# seq, timestamp, CAN ID, DLC, flags (bit 0: extended, bits 4-7: data length), data
+FRAME_SLOT = struct.Struct('<QdIBB2x8s')
+# seq, anomaly bitmask (see anomalies.py)
+VERDICT_SLOT = struct.Struct('<QH6x')
+_COUNTER = struct.Struct('<Q')
+_HEADER_SIZE = 16        # Records written, records read
+
+# CPUs whose stores become visible to other cores in program order (TSO)
+_ORDERED_STORES = ('x86_64', 'amd64', 'i386', 'i686', 'x86')
+
+
+class SharedRing:
+    """Single-producer/single-consumer ring of fixed-size records in shared memory
+
+    The producer publishes a record by bumping the write counter after the
+    record bytes are in place; the consumer frees slots by bumping the read
+    counter. Each side only ever writes its own counter.
+
+    Python issues no memory barriers, so this relies on the CPU keeping
+    plain stores in program order: true on x86 (TSO), not guaranteed on
+    weakly ordered CPUs such as ARM, where a consumer may see the counter
+    before the record (ShardedDetector.start warns there).
+    """
+
+    def __init__(self, record, capacity, name=None):
+        self.record = record
+        self.capacity = capacity
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=_HEADER_SIZE + record.size * capacity)
+            self.shm.buf[:_HEADER_SIZE] = bytes(_HEADER_SIZE)
+        else:
+            # Spawned workers share the parent's resource tracker, so the
+            # creating process alone unlinks the segment
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self._buf = self.shm.buf
+        self._written = _COUNTER.unpack_from(self._buf, 0)[0]
+        self._read = _COUNTER.unpack_from(self._buf, 8)[0]
+
+    def put(self, *fields):
+        """Append one record; returns False (nothing written) if the ring is full"""
+        written = self._written
+        if written - _COUNTER.unpack_from(self._buf, 8)[0] >= self.capacity:
+            return False
+        offset = _HEADER_SIZE + (written % self.capacity) * self.record.size
+        self.record.pack_into(self._buf, offset, *fields)
+        self._written = written + 1
+        _COUNTER.pack_into(self._buf, 0, self._written)
+        return True
+
+    def get_many(self, limit):
+        """Pop up to `limit` records as tuples"""
+        read = self._read
+        available = min(_COUNTER.unpack_from(self._buf, 0)[0] - read, limit)
+        if available <= 0:
+            return []
+        unpack_from, size, capacity = self.record.unpack_from, self.record.size, self.capacity
+        records = [unpack_from(self._buf, _HEADER_SIZE + ((read + i) % capacity) * size)
+                   for i in range(available)]
+        self._read = read + available
+        _COUNTER.pack_into(self._buf, 8, self._read)
+        return records
+
+    def __len__(self):
+        return (_COUNTER.unpack_from(self._buf, 0)[0] -
+                _COUNTER.unpack_from(self._buf, 8)[0])
+
+    def close(self, unlink=False):
+        self._buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _shard_worker(frames_name, verdicts_name, capacity, baseline_path, settings, stop):
+    """Worker process: run the detectors over the frames of one shard"""
+    from main import CANNetworkIDS
+
+    # Detection-only IDS: no bus, no database, no MQTT, no console noise
+    with contextlib.redirect_stdout(io.StringIO()):
+        ids = CANNetworkIDS(channel=None, mqtt_broker=None, db_path=None,
+                            alert_log=None)
+        ids.verbose = False
+        # The setters recompile the derived tables
+        for key, value in settings.items():
+            setattr(ids, key, value)
+        ids.load_baseline(baseline_path)
+
+    frames = SharedRing(FRAME_SLOT, capacity, name=frames_name)
+    verdicts = SharedRing(VERDICT_SLOT, capacity, name=verdicts_name)
+
+    try:
+        while True:
+            records = frames.get_many(256)
+            if not records:
+                # The parent sets stop only once it has stopped dispatching
+                if stop.is_set():
+                    break
+                time.sleep(0.0002)
+                continue
+            for seq, timestamp, can_id, dlc, flags, data in records:
+                msg = can.Message(timestamp=timestamp, arbitration_id=can_id,
+                                  is_extended_id=bool(flags & 1), dlc=dlc,
+                                  data=data[:flags >> 4], check=False)
+                ids._observe(msg, timestamp)
+                mask = ids._detect_anomalies(msg, timestamp)
+                ids._after_detect(msg, mask)
+                # Never drop a verdict: the merger waits for every sequence number
+                while not verdicts.put(seq, mask):
+                    time.sleep(0.0002)
+    finally:
+        frames.close()
+        verdicts.close()
+
+
+class ShardedDetector:
+    """Dispatch frames to per-shard worker processes and merge their verdicts
+
+    Every dispatched frame gets a global sequence number; verdicts are
+    released to the parent IDS strictly in that (arrival, hence timestamp)
+    order, whichever worker finishes first. At most max_in_flight frames
+    await release, and a worker that exits raises RuntimeError from
+    collect() instead of stalling the merger.
+    """
+
+    LIVENESS_INTERVAL = 0.5    # Seconds between worker exit checks
+
+    def __init__(self, ids, workers=None, capacity=65536, partition='hash'):
+        if partition not in ('hash', 'range'):
+            raise ValueError(f"Unknown partition scheme: {partition}")
+        self.ids = ids
+        self.workers = workers or os.cpu_count() or 1
+        self.capacity = capacity
+        self.partition = partition
+        self.max_in_flight = self.workers * capacity
+
+        self._next_seq = 0       # Next sequence number to dispatch
+        self._emit_seq = 0       # Next sequence number to release
+        self._pending = {}       # seq -> (msg, timestamp) awaiting a verdict
+        self._ready = {}         # seq -> anomaly bitmask
+        self._next_check = 0.0   # monotonic time of the next liveness check
+
+        self.frame_rings = []
+        self.verdict_rings = []
+        self.processes = []
+        self.dispatched = [0] * self.workers
+        self.dropped = [0] * self.workers
+        self._stop = None
+        self._baseline_path = None
+
+    def shard_of(self, can_id):
+        """Worker index owning a CAN ID"""
+        if self.partition == 'range' and can_id < 0x800:
+            return can_id * self.workers >> 11
+        # Multiplicative hash spreads neighbouring IDs across workers
+        return ((can_id * 2654435761) >> 16) % self.workers
+
+    def start(self):
+        if platform.machine().lower() not in _ORDERED_STORES:
+            print(f"Warning: shared-memory rings assume x86 store ordering; on "
+                  f"{platform.machine()} prefer run_pipelined() or run_batched()")
+        ids = self.ids
+        fd, self._baseline_path = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        save_baseline(self._baseline_path, ids.baseline_dlc, ids.payload_stats,
+                      ids.interarrival, ids.payload_profiles)
+        settings = {key: getattr(ids, key) for key in SHARED_SETTINGS}
+
+        ctx = mp.get_context('spawn')
+        self._stop = ctx.Event()
+        for shard in range(self.workers):
+            frames = SharedRing(FRAME_SLOT, self.capacity)
+            verdicts = SharedRing(VERDICT_SLOT, self.capacity)
+            process = ctx.Process(
+                target=_shard_worker, name=f"ids-shard-{shard}", daemon=True,
+                args=(frames.name, verdicts.name, self.capacity,
+                      self._baseline_path, settings, self._stop))
+            process.start()
+            self.frame_rings.append(frames)
+            self.verdict_rings.append(verdicts)
+            self.processes.append(process)
+
+    def dispatch(self, msg, timestamp):
+        """
+        Hand one frame to its shard
+        Returns False (counted as a drop) if that shard's ring is full or
+        max_in_flight frames already await their verdicts.
+        """
+        shard = self.shard_of(msg.arbitration_id)
+        if self._next_seq - self._emit_seq >= self.max_in_flight:
+            self.dropped[shard] += 1
+            return False
+        data = bytes(msg.data[:8])
+        flags = int(bool(msg.is_extended_id)) | (len(data) << 4)
+        if not self.frame_rings[shard].put(self._next_seq, timestamp, msg.arbitration_id,
+                                           msg.dlc, flags, data):
+            self.dropped[shard] += 1
+            return False
+        self.dispatched[shard] += 1
+        self._pending[self._next_seq] = (msg, timestamp)
+        self._next_seq += 1
+        return True
+
+    def collect(self):
+        """Gather worker verdicts and release those next in sequence"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.LIVENESS_INTERVAL
+            self.check_workers()
+        return self._release()
+
+    def check_workers(self):
+        """Raise RuntimeError if a worker exited: its frames would never be released"""
+        for process in self.processes:
+            if process.exitcode is not None:
+                raise RuntimeError(f"Detection process {process.name} exited "
+                                   f"with code {process.exitcode}")
+
+    def _release(self):
+        """Move worker verdicts into the merger and log those next in sequence"""
+        for ring in self.verdict_rings:
+            for seq, mask in ring.get_many(4096):
+                self._ready[seq] = mask
+
+        released = 0
+        ready, pending, ids = self._ready, self._pending, self.ids
+        while self._emit_seq in ready:
+            mask = ready.pop(self._emit_seq)
+            msg, timestamp = pending.pop(self._emit_seq)
+            self._emit_seq += 1
+            released += 1
+
+            # The workers own detection; the parent keeps the per-ID counts
+            # and, through online learning, a baseline in step with theirs
+            ids._observe(msg, timestamp)
+            ids._respond(msg, timestamp, mask)
+        return released
+
+    def in_flight(self):
+        return self._next_seq - self._emit_seq
+
+    def stop(self, timeout=5.0):
+        """Wait for outstanding verdicts, then stop the workers and free memory"""
+        deadline = time.monotonic() + timeout
+        while self.in_flight() and time.monotonic() < deadline:
+            if not self._release():
+                # A dead worker's frames never arrive: do not wait for them
+                if any(process.exitcode is not None for process in self.processes):
+                    break
+                time.sleep(0.001)
+        if self._stop is not None:
+            self._stop.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for ring in self.frame_rings + self.verdict_rings:
+            ring.close(unlink=True)
+        if self._baseline_path and os.path.exists(self._baseline_path):
+            os.remove(self._baseline_path)
+
+    def stats(self):
+        """Per-shard queue depth, dispatch and drop counters"""
+        stats = {}
+        for shard in range(len(self.frame_rings)):
+            stats[f"shard{shard}"] = {
+                'depth': len(self.frame_rings[shard]),
+                'dispatched': self.dispatched[shard],
+                'dropped': self.dropped[shard],
+                'alive': self.processes[shard].is_alive(),
+            }
+        stats['merger'] = {'in_flight': self.in_flight()}
+        return stats
@@ -0,0 +1,517 @@
+"""
+Persistence backend for the CAN Network IDS
+Write-behind SQLite logging flushed in batches from a dedicated thread
+"""
+
+import calendar
+import glob
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from metrics import Histogram
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+LAYOUTS = ('rows', 'packed')
+
+# PRAGMA user_version: 1 = channel/anomaly_mask columns, 2 = binary payloads,
+# 3 = anomaly_minutes aggregate
+SCHEMA_VERSION = 3
+
+# Packed layout: one 24-byte record per frame; each frame_blocks row holds a
+# zlib-compressed run of records from one channel
+PACKED_RECORD = struct.Struct('<dIBB2x8s')    # timestamp, can_id, dlc, flags, payload
+FRAME_DTYPE = np.dtype([('timestamp', '<f8'), ('can_id', '<u4'), ('dlc', 'u1'),
+                        ('flags', 'u1'), ('pad', 'V2'), ('data', 'u1', 8)])
+FLAG_ANOMALY = 0x01
+FLAG_EXTENDED = 0x02    # 29-bit identifier (capture rings; frame_blocks do not set it)
+
+# Partition files are named <root>-<UTC start><ext>, e.g. can_ids-20250101T130000.db
+PARTITION_TIME = '%Y%m%dT%H%M%S'
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL,
+        can_id INTEGER,
+        dlc INTEGER,
+        data BLOB,
+        is_anomaly BOOLEAN,
+        channel TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS anomalies (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL,
+        can_id INTEGER,
+        anomaly_type TEXT,
+        severity TEXT,
+        details TEXT,
+        channel TEXT,
+        anomaly_mask INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS frame_blocks (
+        id INTEGER PRIMARY KEY,
+        first_ts REAL,
+        last_ts REAL,
+        channel TEXT,
+        frames INTEGER,
+        records BLOB
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS frame_blocks_time ON frame_blocks (first_ts)',
+    # Appends in time order, so cheap to maintain; per-ID lookups use anomalies
+    'CREATE INDEX IF NOT EXISTS messages_time ON messages (timestamp)',
+    'CREATE INDEX IF NOT EXISTS anomalies_time ON anomalies (timestamp)',
+    'CREATE INDEX IF NOT EXISTS anomalies_id_time ON anomalies (can_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS anomalies_type_time ON anomalies (anomaly_type, timestamp)',
+    # Anomaly counts per minute, maintained by the writer (channel '' = none)
+    '''
+    CREATE TABLE IF NOT EXISTS anomaly_minutes (
+        minute INTEGER NOT NULL,
+        anomaly_type TEXT NOT NULL,
+        can_id INTEGER NOT NULL,
+        channel TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (minute, anomaly_type, can_id, channel)
+    ) WITHOUT ROWID
+    ''',
+    # Per-ID, per-second benign traffic (summary persistence policy)
+    '''
+    CREATE TABLE IF NOT EXISTS message_seconds (
+        id INTEGER PRIMARY KEY,
+        second INTEGER,
+        can_id INTEGER,
+        channel TEXT,
+        frames INTEGER,
+        value_min REAL,
+        value_max REAL,
+        value_mean REAL,
+        dlc_counts TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS message_seconds_time ON message_seconds (second)',
+    '''
+    CREATE TABLE IF NOT EXISTS metrics (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL,
+        name TEXT,
+        labels TEXT,
+        value REAL
+    )
+    ''',
+)
+
+# Columns added after the first release: (table, column, type)
+ADDED_COLUMNS = (
+    ('messages', 'channel', 'TEXT'),
+    ('anomalies', 'channel', 'TEXT'),
+    ('anomalies', 'anomaly_mask', 'INTEGER'),
+)
+
+INSERT_MESSAGE = '''
+    INSERT INTO messages
+    (timestamp, can_id, dlc, data, is_anomaly, channel)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_ANOMALY = '''
+    INSERT INTO anomalies
+    (timestamp, can_id, anomaly_type, severity, details, channel, anomaly_mask)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_BLOCK = '''
+    INSERT INTO frame_blocks
+    (first_ts, last_ts, channel, frames, records)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+UPSERT_MINUTE = '''
+    INSERT INTO anomaly_minutes
+    (minute, anomaly_type, can_id, channel, count)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (minute, anomaly_type, can_id, channel)
+    DO UPDATE SET count = count + excluded.count
+'''
+
+INSERT_SUMMARY = '''
+    INSERT INTO message_seconds
+    (second, can_id, channel, frames, value_min, value_max, value_mean, dlc_counts)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_METRIC = '''
+    INSERT INTO metrics
+    (timestamp, name, labels, value)
+    VALUES (?, ?, ?, ?)
+'''
+
+
+def open_database(path, synchronous='NORMAL'):
+    """Connect to `path`, creating or migrating the schema as needed"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={synchronous}')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    _migrate(conn, path)
+    conn.commit()
+    return conn
+
+
+def _migrate(conn, path):
+    """Bring databases created by earlier versions up to SCHEMA_VERSION"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"{path} has schema version {version}; "
+                         f"this IDS supports up to {SCHEMA_VERSION}")
+    if version < 1:
+        for table, column, kind in ADDED_COLUMNS:
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            if column not in columns:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+    if version < 2:
+        converted = _unhex_payloads(conn)
+        if converted:
+            print(f"Converted {converted} hex payloads in {path} to binary")
+    if version < 3:
+        conn.execute('''
+            INSERT INTO anomaly_minutes (minute, anomaly_type, can_id, channel, count)
+            SELECT CAST(timestamp / 60 AS INTEGER) * 60, anomaly_type, can_id,
+                   COALESCE(channel, ''), count(*)
+            FROM anomalies GROUP BY 1, 2, 3, 4
+        ''')
+    conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+
+def _unhex_payloads(conn, chunk=50000):
+    """Rewrite payloads stored as hex TEXT (before version 2) as raw bytes"""
+    select = ("SELECT id, data FROM messages WHERE typeof(data) = 'text' "
+              "AND id > ? ORDER BY id LIMIT ?")
+    last, converted = 0, 0
+    while True:
+        rows = conn.execute(select, (last, chunk)).fetchall()
+        if not rows:
+            return converted
+        conn.executemany('UPDATE messages SET data = ? WHERE id = ?',
+                         [(bytes.fromhex(data), row_id) for row_id, data in rows])
+        last = rows[-1][0]
+        converted += len(rows)
+
+
+def partition_path(path, start):
+    """File of the partition of `path` starting at `start` (epoch seconds)"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{time.strftime(PARTITION_TIME, time.gmtime(start))}{ext or '.db'}"
+
+
+def list_partitions(path):
+    """(start, file) for every partition of `path` on disk, oldest first"""
+    root, ext = os.path.splitext(path)
+    ext = ext or '.db'
+    found = []
+    for file in glob.glob(f"{glob.escape(root)}-*{ext}"):
+        try:
+            start = calendar.timegm(time.strptime(file[len(root) + 1:-len(ext)], PARTITION_TIME))
+        except ValueError:
+            continue
+        found.append((start, file))
+    return sorted(found)
+
+
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def minute_counts(anomalies):
+    """anomaly_minutes upsert rows for a batch of anomalies rows"""
+    counts = Counter((int(row[0] // 60) * 60, row[2], row[1], row[5] or '')
+                     for row in anomalies)
+    return [key + (count,) for key, count in counts.items()]
+
+
+def pack_frames(rows):
+    """messages rows -> (first_ts, last_ts, channel, frames, records) per channel"""
+    by_channel = {}
+    pack = PACKED_RECORD.pack
+    for timestamp, can_id, dlc, data, is_anomaly, channel in rows:
+        by_channel.setdefault(channel, ([], []))
+        times, records = by_channel[channel]
+        times.append(timestamp)
+        records.append(pack(timestamp, can_id, dlc, FLAG_ANOMALY if is_anomaly else 0, data))
+    return [(min(times), max(times), channel, len(records), zlib.compress(b''.join(records), 1))
+            for channel, (times, records) in by_channel.items()]
+
+
+def read_frames(conn, start=None, end=None, channel=None):
+    """
+    Frames of the packed layout as a FRAME_DTYPE array, in insertion order
+    start/end bound the timestamp (inclusive); channel=None reads all channels.
+    """
+    query = 'SELECT records FROM frame_blocks WHERE 1'
+    params = []
+    if start is not None:
+        query += ' AND last_ts >= ?'
+        params.append(start)
+    if end is not None:
+        query += ' AND first_ts <= ?'
+        params.append(end)
+    if channel is not None:
+        query += ' AND channel = ?'
+        params.append(channel)
+    blob = b''.join(zlib.decompress(row[0])
+                    for row in conn.execute(query + ' ORDER BY id', params))
+    frames = np.frombuffer(blob, dtype=FRAME_DTYPE)
+    if start is not None:
+        frames = frames[frames['timestamp'] >= start]
+    if end is not None:
+        frames = frames[frames['timestamp'] <= end]
+    return frames
+
+
+class DatabaseWriter:
+    """
+    Buffer rows in memory and write them with executemany on a writer thread
+    layout='rows' writes one messages row per frame; 'packed' writes frames
+    as 24-byte records into frame_blocks (read them back with read_frames).
+
+    With partition_seconds, rows go to one database file per period of
+    frame time (see partition_path). When a newer partition opens,
+    partitions that ended more than `retention` seconds earlier are
+    deleted, and those older than `compact_after` lose their frames
+    (messages, frame_blocks) but keep anomalies and aggregates.
+    """
+
+    def __init__(self, path='can_ids.db', batch_size=500, flush_interval=1.0,
+                 synchronous='NORMAL', max_pending=100000, block_when_full=False,
+                 layout='rows', partition_seconds=None, retention=None, compact_after=None):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode: {synchronous}")
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown database layout: {layout}")
+
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block_when_full = block_when_full   # Wait for the writer instead of dropping
+        self.layout = layout
+        self.synchronous = synchronous
+        self.partition_seconds = partition_seconds
+        self.retention = retention
+        self.compact_after = compact_after
+
+        # Schema is created here; afterwards only the writer thread touches conn
+        self.conn = None
+        self._partitions = {}      # Partition start -> connection (at most two open)
+        self._newest = None        # Start of the newest partition written
+        if not partition_seconds:
+            self.conn = open_database(path, synchronous)
+
+        self._messages = []
+        self._anomalies = []
+        self._metrics = []
+        self._summaries = []
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # Statistics
+        self.rows_written = 0
+        self.flush_count = 0
+        self.dropped = 0
+        self.errors = 0
+        self.flush_seconds = Histogram()
+        self.partitions_removed = 0
+        self.partitions_compacted = 0
+
+        self._thread = threading.Thread(target=self._run, name='ids-db-writer',
+                                        daemon=True)
+        self._thread.start()
+
+    def log_message(self, row):
+        """Queue a messages row: (timestamp, can_id, dlc, data, is_anomaly, channel)"""
+        self._enqueue('_messages', row)
+
+    def log_messages(self, rows):
+        """Queue several messages rows at once (one lock round-trip)"""
+        with self._cond:
+            while True:
+                room = max(self.max_pending - self.pending(), 0)
+                if len(rows) <= room:
+                    break
+                if not self.block_when_full:
+                    self.dropped += len(rows) - room
+                    rows = rows[:room]
+                    break
+                # Queue what fits, then wait for the writer (as _enqueue does)
+                self._messages.extend(rows[:room])
+                rows = rows[room:]
+                self._cond.notify_all()
+                self._cond.wait()
+            self._messages.extend(rows)
+            if self.pending() >= self.batch_size:
+                self._cond.notify_all()
+
+    def log_anomaly(self, row):
+        """Queue an anomalies row: (timestamp, can_id, type, severity, details, channel, mask)"""
+        self._enqueue('_anomalies', row)
+
+    def log_metrics(self, rows):
+        """Queue metrics snapshot rows: (timestamp, name, labels, value)"""
+        with self._cond:
+            self._metrics.extend(rows)    # Written with the next batch
+
+    def log_summaries(self, rows):
+        """Queue message_seconds rows (see persistence.SummaryPolicy)"""
+        with self._cond:
+            self._summaries.extend(rows)    # Written with the next batch
+
+    def pending(self):
+        """Rows buffered but not yet written"""
+        return len(self._messages) + len(self._anomalies)
+
+    def _enqueue(self, buffer, row):
+        # The buffer is looked up under the lock: the writer swaps in a new list
+        with self._cond:
+            while self.pending() >= self.max_pending:
+                if not self.block_when_full:
+                    # Disk cannot keep up; shed load instead of growing without bound
+                    self.dropped += 1
+                    return
+                self._cond.notify_all()
+                self._cond.wait()
+            getattr(self, buffer).append(row)
+            if self.pending() >= self.batch_size:
+                self._cond.notify_all()
+
+    def _run(self):
+        """Writer thread: flush on batch size, flush interval or close"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or self.pending() >= self.batch_size,
+                    timeout=self.flush_interval
+                )
+                messages, self._messages = self._messages, []
+                anomalies, self._anomalies = self._anomalies, []
+                metrics, self._metrics = self._metrics, []
+                summaries, self._summaries = self._summaries, []
+                closed = self._closed
+                self._cond.notify_all()    # Wake producers blocked on a full buffer
+
+            if messages or anomalies or metrics or summaries:
+                self._write(messages, anomalies, metrics, summaries)
+            if closed:
+                break
+
+    def _write(self, messages, anomalies, metrics=(), summaries=()):
+        """Write one batch, in a single transaction per partition"""
+        started = time.perf_counter()
+        if self.partition_seconds:
+            batches = self._split(messages, anomalies, metrics, summaries)
+        else:
+            batches = [(None, (messages, anomalies, metrics, summaries))]
+        for start, (messages, anomalies, metrics, summaries) in batches:
+            path = self.path if start is None else partition_path(self.path, start)
+            try:
+                conn = self.conn if start is None else self._partition(start)
+                with conn:
+                    if messages and self.layout == 'packed':
+                        conn.executemany(INSERT_BLOCK, pack_frames(messages))
+                    elif messages:
+                        conn.executemany(INSERT_MESSAGE, messages)
+                    if anomalies:
+                        conn.executemany(INSERT_ANOMALY, anomalies)
+                        conn.executemany(UPSERT_MINUTE, minute_counts(anomalies))
+                    if metrics:
+                        conn.executemany(INSERT_METRIC, metrics)
+                    if summaries:
+                        conn.executemany(INSERT_SUMMARY, summaries)
+                self.rows_written += len(messages) + len(anomalies) + len(summaries)
+            except sqlite3.Error as e:
+                self.errors += 1
+                rows = len(messages) + len(anomalies) + len(metrics) + len(summaries)
+                print(f"Warning: Could not write {rows} rows to {path}: {e}")
+        self.flush_count += 1
+        self.flush_seconds.observe(time.perf_counter() - started)
+
+    def _split(self, *tables):
+        """Group a batch by the partition of each row's timestamp (first column)"""
+        size = self.partition_seconds
+        groups = {}
+        for index, rows in enumerate(tables):
+            for row in rows:
+                groups.setdefault(row[0] // size * size,
+                                  tuple([] for _ in tables))[index].append(row)
+        return sorted(groups.items())
+
+    def _partition(self, start):
+        """Connection to the partition starting at `start`, rotating as needed"""
+        conn = self._partitions.get(start)
+        if conn is not None:
+            return conn
+        conn = self._partitions[start] = open_database(partition_path(self.path, start),
+                                                       self.synchronous)
+        # Keep the current and one earlier partition open, for late frames
+        while len(self._partitions) > 2:
+            self._partitions.pop(min(self._partitions)).close()
+        if self._newest is None or start > self._newest:
+            self._newest = start
+            self._apply_retention()
+        return conn
+
+    def _apply_retention(self):
+        """Delete or compact partitions that ended long enough before the newest"""
+        for start, path in list_partitions(self.path):
+            if start in self._partitions:
+                continue
+            age = self._newest - (start + self.partition_seconds)
+            try:
+                if self.retention is not None and age >= self.retention:
+                    remove_database(path)
+                    self.partitions_removed += 1
+                elif self.compact_after is not None and age >= self.compact_after:
+                    self._compact(path)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Warning: Could not apply retention to {path}: {e}")
+
+    def _compact(self, path):
+        """Drop the frames of a closed partition, keeping anomalies and aggregates"""
+        conn = sqlite3.connect(path)
+        try:
+            if (conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone() is None and
+                    conn.execute('SELECT 1 FROM frame_blocks LIMIT 1').fetchone() is None):
+                return    # Already compacted
+            with conn:
+                conn.execute('DELETE FROM messages')
+                conn.execute('DELETE FROM frame_blocks')
+            conn.execute('VACUUM')
+            self.partitions_compacted += 1
+        finally:
+            conn.close()
+
+    def close(self):
+        """Flush everything still buffered and stop the writer thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self.conn is not None:
+            self.conn.close()
+        for conn in self._partitions.values():
+            conn.close()
+        self._partitions.clear()